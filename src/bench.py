@@ -0,0 +1,112 @@
+'''
+Throughput benchmark of the stream pipeline (TwitterSession.stream -> process_tweets -> Handle.write)
+against the local fake API, for a matrix of rule and handle counts.
+
+    python bench.py --rules 1,10,100 --handles 1,10,50 --duration 10
+
+Reports the sustained tweets/sec, p50/p99 dispatch latency and the resident memory of each run
+
+@author: diego
+'''
+from net.utils import TwitterSession, Rule
+from metrics import StreamMetrics
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import globals
+
+def rss_mb():
+    '''current resident memory, or the peak where /proc isn't available'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def start_server(port, args):
+    '''runs the fake API in its own process so it doesn't share the loop being measured'''
+    command = [sys.executable, '-m', 'net.fake_server', '--port', str(port), '--rate', str(args.rate)]
+    if args.replay:
+        command.extend(['--replay', args.replay])
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("fake server didn't start")
+
+def reset():
+    '''forget the rules and handles of the previous run'''
+    globals.HANDLES.clear()
+    globals.SUBSCRIPTIONS.clear()
+    globals.RULES.clear()
+    globals.compile_keywords()
+    globals.compile_dispatch()
+    globals.METRICS = StreamMetrics()
+    
+async def run(base_url, n_rules, n_handles, args, folder):
+    reset()
+    session = await TwitterSession('bench', base_url=base_url)
+    try:
+        await session.remove_all_rules()
+        rules = [Rule(f"bench{i}", tag=f"bench{i}", name=f"bench{i}") for i in range(n_rules)]
+        await session.modify_rules(add=rules)
+        for rule in rules:
+            globals.add_rule(rule)
+        for i in range(n_handles):
+            globals.add_handle(globals.Handle(f"h{i}", os.path.join(folder, f"h{i}.jsonl"), [rules[i % n_rules].name],
+                                              threaded=args.threaded, raw=args.raw))
+        
+        await globals.start(session.stream(globals.stream_params()), workers=args.workers)
+        await asyncio.sleep(args.warmup)
+        tweets, start = globals.METRICS.tweets, time.perf_counter()
+        await asyncio.sleep(args.duration)
+        tweets, elapsed = globals.METRICS.tweets - tweets, time.perf_counter() - start
+        dispatch = globals.METRICS.dispatch
+        memory = rss_mb()
+        globals.close()
+    finally:
+        await session.close()
+    return tweets / elapsed, dispatch.quantile(0.5), dispatch.quantile(0.99), memory
+
+async def main(args):
+    port = args.port
+    server = start_server(port, args)
+    try:
+        print(f"{'rules':>6} {'handles':>8} {'tweets/s':>10} {'p50 us':>8} {'p99 us':>8} {'rss MB':>8}")
+        with tempfile.TemporaryDirectory() as folder:
+            for n_rules in args.rules:
+                for n_handles in args.handles:
+                    rate, p50, p99, memory = await run(f"http://127.0.0.1:{port}", n_rules, n_handles, args, folder)
+                    print(f"{n_rules:>6} {n_handles:>8} {rate:>10.0f} {p50*1e6:>8.1f} {p99*1e6:>8.1f} {memory:>8.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+def _counts(text):
+    return [int(x) for x in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stream pipeline against the local fake API")
+    parser.add_argument('--rules', type=_counts, default=[1, 10, 100], help="comma separated rule counts")
+    parser.add_argument('--handles', type=_counts, default=[1, 10, 50], help="comma separated handle counts")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured per run")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds before measuring")
+    parser.add_argument('--rate', type=float, default=0.0, help="tweets per second sent, 0 for as fast as possible")
+    parser.add_argument('--replay', help="JSONL file replayed by the fake API instead of generated tweets")
+    parser.add_argument('--threaded', action='store_true', help="use the writer pool for the handles")
+    parser.add_argument('--raw', action='store_true', help="write whole responses, tweets going only to raw handles aren't decoded")
+    parser.add_argument('--workers', type=int, default=0, help="parse on this many worker processes")
+    parser.add_argument('--port', type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
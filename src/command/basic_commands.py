@@ -6,38 +6,187 @@ Created on Oct 19, 2022
 
 from command import commands
 from command.commands import Command, CommandGroup
-from net.utils import Rule, RulesCapExceeded, DuplicateRule, InvalidRule
+from net.utils import Rule, RulesCapExceeded, DuplicateRule, InvalidRule, normalize, chunks, \
+    MAX_ADD_PER_REQUEST, MAX_DELETE_PER_REQUEST
+from net import packing, sync
+from output.pool import POLICIES
+from output.files import check_format
+from output.sinks import is_sink, check_sink
+from output.columnar import check_columnar, COLUMNAR_FORMATS
 from pprint import pprint
+from orjson import orjson
 import globals
+import metrics
+import fields
+from filters import Predicate
+import re
+import time
 
 from typing import Optional
-import itertools
 
-async def sync_rules():
-    '''grabs and compares rules from server and locally
-    automatically fetches rules, but pushing rules is still
-    to be implemented
+def _split_options(args):
+    '''separates '--key=value' and '--flag' tokens from the positional arguments
     
-    return the descrepencies
+    return the positional arguments and a dict of options, flags map to True
     '''
+    positional = list()
+    options = dict()
+    for arg in args:
+        if arg.startswith('--'):
+            key, _, value = arg[2:].partition('=')
+            options[key] = value if value else True
+        else:
+            positional.append(arg)
+    return positional, options
+
+def _parse_size(size: str) -> int:
+    '''reads sizes like '512', '64K', '100M' or '2G' as bytes'''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def _handle_kwargs(options):
+    '''converts the options of 'handle add' into keyword arguments of Handle
+    throws ValueError for malformed values'''
+    kwargs = dict()
+    if 'raw' in options:
+        kwargs['raw'] = True
+    try:
+        if 'flush-size' in options:
+            kwargs['flush_size'] = _parse_size(options['flush-size'])
+        if 'flush-interval' in options:
+            kwargs['flush_interval'] = float(options['flush-interval'])
+        if 'queue' in options:
+            kwargs['max_batches'] = int(options['queue'])
+        if 'row-group' in options:
+            kwargs['row_group_size'] = int(options['row-group'])
+        if 'level' in options:
+            kwargs['level'] = int(options['level'])
+        if 'rotate-size' in options:
+            kwargs['rotate_size'] = _parse_size(options['rotate-size'])
+        if 'rotate-interval' in options:
+            kwargs['rotate_interval'] = float(options['rotate-interval'])
+    except ValueError:
+        raise ValueError("size, time and level options need numbers, EX: --flush-size=64K --rotate-interval=3600")
     
-    ls = (await globals.SESSION.get_rules())['data']
-    pulls = list()
-    pushs = list()
-    pushs.extend([rule.id for rule in globals.RULES.values()])
-    
-    for x in ls:
-        if x['id'] in globals.RULES.keys():
-            try: 
-                pushs.remove(x['id'])
-            except ValueError: pass
-            
-            globals.RULES[x[id]].rules = x['value']
-            globals.RULES[x[id]].tag = x['tag']
+    filters = {'keywords': 'keywords', 'authors': 'authors', 'exclude-authors': 'exclude_authors', 'lang': 'lang'}
+    predicate = {arg: [x.strip() for x in str(options[option]).split(',') if x.strip()] 
+                 for option, arg in filters.items() if option in options}
+    if 'regex' in options:
+        try:
+            re.compile(str(options['regex']))
+        except re.error as e:
+            raise ValueError(f"invalid --regex: {e}")
+        predicate['regex'] = str(options['regex'])
+    if predicate:
+        kwargs['predicate'] = Predicate(**predicate)
+        
+    if 'fields' in options:
+        if 'raw' in options:
+            raise ValueError("--raw writes whole responses, it can't be combined with --fields")
+        kwargs['fields'] = fields.parse(str(options['fields']))
+    if 'format' in options:
+        if options['format'] in COLUMNAR_FORMATS:
+            check_columnar()
+            if options.get('backpressure') == 'spill':
+                raise ValueError("columnar handles can't spill, use block or drop")
         else:
-            pulls.append(Rule(rules=x['value'], tag=x['tag'], id=x['id']))
-            globals.add_rule(pulls[-1])
-    return pulls, pushs
+            check_format(options['format'])
+        kwargs['format'] = options['format']
+    
+    if 'threaded' in options or 'backpressure' in options:
+        kwargs['threaded'] = True
+    if 'backpressure' in options:
+        if options['backpressure'] not in POLICIES:
+            raise ValueError(f"backpressure must be one of {', '.join(POLICIES)}")
+        kwargs['backpressure'] = options['backpressure']
+    return kwargs
+
+def _check_output(file, format='plain', rotating=False, backpressure=None):
+    '''throws ValueError if a handle with these options can't write to file, sinks only take plain lines'''
+    if not is_sink(file):
+        return
+    check_sink(file)
+    if format != 'plain' or rotating:
+        raise ValueError("sinks take plain lines, --format and --rotate-* are for files")
+    if backpressure == 'spill':
+        raise ValueError("sinks can't spill, their buffer drops the oldest tweets when it's full")
+
+def _rekey(rule, old):
+    '''follows a rule whose server id changed from old to rule.id, adding it if it wasn't known'''
+    new = rule.id
+    if old == new:
+        return
+    if old in globals.PACKED_RULES:
+        globals.PACKED_RULES[new] = globals.PACKED_RULES.pop(old)
+        globals.PACKED[new] = globals.PACKED.pop(old)
+        globals.update_dispatch([]) # the pipeline's copy of PACKED is stale
+    elif old in globals.RULES:
+        rule.id = old
+        globals.replace_rule_id(old, new)
+    else:
+        globals.add_rule(rule)
+
+async def _push(changes: sync.RuleDiff) -> int:
+    '''sends a diff and gives the local rules their server ids, returns the number of requests'''
+    previous = [(rule, rule.id) for rule in changes.add]
+    try:
+        return await sync.apply(globals.SESSION, changes)
+    finally:
+        for rule, server_id in changes.keep:
+            old, rule.id = rule.id, server_id
+            _rekey(rule, old)
+        for rule, old in previous:
+            if rule.id is not None:
+                _rekey(rule, old)
+
+async def _modify(add: list=(), delete: list=()):
+    '''adds and deletes in as many requests as the limits per request need, the adds first'''
+    for chunk in chunks(add, MAX_ADD_PER_REQUEST):
+        await globals.SESSION.modify_rules(add=chunk)
+    for chunk in chunks(delete, MAX_DELETE_PER_REQUEST):
+        await globals.SESSION.modify_rules(delete=chunk)
+
+async def sync_rules(server: list=None):
+    '''grabs and compares rules from server and locally, the server's rules
+    unknown locally are added locally. 'rules sync' pushes the local ones.
+    server is the 'data' of a get_rules response already at hand
+    
+    return the descrepencies
+    '''
+    
+    if server is None:
+        server = (await globals.SESSION.get_rules()).get('data', [])
+    changes = sync.diff(globals.server_rules(), server, pull=True)
+    for rule, server_id in changes.keep:
+        old, rule.id = rule.id, server_id
+        _rekey(rule, old)
+    for rule in changes.pull:
+        globals.add_rule(rule)
+    return changes.pull, [rule.id for rule in changes.add]
+
+async def _bind_duplicate(rule):
+    '''names the rule the server already has with rule's value, as a script run again
+    against the same app finds its rules pulled under other names'''
+    value = normalize(rule.rules)
+    existing = next((known for known in globals.RULES.values() if normalize(known.rules) == value), None)
+    if existing is None:
+        server = (await globals.SESSION.get_rules()).get('data', [])
+        found = next((found for found in server if normalize(found['value']) == value 
+                      and found['id'] not in globals.PACKED_RULES), None)
+        if found is None:
+            print("A duplicate was found, rule not added")
+            return
+        existing = Rule(found['value'], tag=found.get('tag'), id=found['id'], name=rule.name)
+        globals.add_rule(existing)
+    elif existing.name != rule.name:
+        if globals.get_rule_by_name(rule.name) is not None:
+            print("A duplicate named '{}' was found, rule not added".format(existing.name))
+            return
+        globals.RULES.rename(existing.id, rule.name)
+    print("The rule was already added, it's named '{}' now".format(rule.name))
 
 class rules(commands.CommandGroup):
     '''Access and modify current rules'''
@@ -48,6 +197,10 @@ class rules(commands.CommandGroup):
         self.add_command(self.delete)
         self.add_command(self.view)
         self.add_command(self.list)
+        self.add_command(self.pack)
+        self.add_command(self.unpack)
+        self.add_command(self.sync)
+        self.add_command(self.load)
         
             
     @Command.command(description="Add a rule to the stream")
@@ -59,11 +212,11 @@ class rules(commands.CommandGroup):
             globals.add_rule(rule)
             
             print("")
+        except DuplicateRule as d:
+            await _bind_duplicate(rule)
         except InvalidRule as i:
             print("Couldn't add rule, invalid syntax:")
             pprint(str(i))
-        except DuplicateRule as d:
-            print("A duplicate was found, rule not added")
         except RulesCapExceeded as r:
             print("Rules cap exceeded, rule couldn't be added. Either delete rule or change bearer token")
         else:
@@ -75,15 +228,34 @@ class rules(commands.CommandGroup):
         rule = globals.get_rule_by_name(name)
         
         if name == "*":
-            await globals.SESSION.remove_all_rules()
+            await _modify(delete=[rule.id for rule in globals.server_rules()])
             globals.RULES.clear()
+            globals.compile_dispatch()
+            globals.PACKED.clear()
+            globals.PACKED_RULES.clear()
+            globals.PACKED_NEEDS.clear()
             return
         
         if rule is None:
             print("Rule {} doesn't exist".format(name))
             return
         
-        await globals.SESSION.modify_rules(delete=[rule.id])
+        if rule.id in globals.packed_rule_ids():
+            # the server rule still matches for the others, the tweets just aren't routed to it anymore
+            for server_id, members in globals.PACKED.items():
+                globals.PACKED[server_id] = tuple(member for member in members if member.id != rule.id)
+            emptied = [server_id for server_id, members in globals.PACKED.items() if not members]
+            await _modify(delete=emptied) # they'd use up tweets routed nowhere
+            for server_id in emptied:
+                del globals.PACKED[server_id]
+                del globals.PACKED_RULES[server_id]
+            globals.PACKED_NEEDS.clear()
+            globals.PACKED_NEEDS.update(fields.merge(packing.needs(member.tree) 
+                                                    for members in globals.PACKED.values() for member in members))
+            if globals.get_stream() is not None:
+                globals.refresh_params()
+        else:
+            await globals.SESSION.modify_rules(delete=[rule.id])
         globals.rem_rule(rule.id)
         
         print("Rule deleted")
@@ -120,9 +292,137 @@ class rules(commands.CommandGroup):
     async def list(self):
         print("\n".join(sorted([f"\t{x.name}: '{x.rules}'    <TAG:> '{x.tag}' {{{x.id}}}" for x in globals.RULES.values()])))
     
-    @Command.command(description="Syncs the rules with the Twitter Server")
-    async def sync(self):
-        pass #TODO
+    @Command.command(description="OR-merges the rules into as few server rules as fit the length cap "
+                     "(512, or 1024 with academic access), tweets are matched back to the rules locally")
+    async def pack(self, max_length: Optional=None):
+        max_length = int(max_length) if max_length else packing.MAX_RULE_LENGTH
+        logical = list(globals.RULES.values())
+        was_packed = globals.packed_rule_ids()
+        try:
+            local = {rule.id: packing.LogicalRule(rule.id, rule.tag, rule.rules) for rule in logical}
+        except ValueError as e:
+            print(f"Couldn't read a rule to match it locally: {e}")
+            return
+        plan = packing.plan(logical, max_length)
+        groups = [(server, members) for server, members in plan 
+                  if len(members) > 1 or members[0].id in was_packed]
+        
+        # groups whose value is already a packed rule on the server keep it, only the others are added
+        existing = {normalize(rule.rules): rule for rule in globals.PACKED_RULES.values()}
+        groups = [(existing.get(normalize(server.rules), server), members) for server, members in groups]
+        added = [server for server, _ in groups if server.id is None]
+        try:
+            await _modify(add=added)
+        except InvalidRule as i:
+            created = [server.id for server in added if server.id is not None]
+            # the server adds the valid rules of a request, and the chunks before it went through
+            await _modify(delete=created)
+            print("Couldn't add packed rule:")
+            pprint(str(i))
+            return
+        
+        # the packed rules are live, now the rules they replace can go
+        replaced = [rule.id for _, members in groups for rule in members if rule.id not in was_packed]
+        kept = {server.id for server, _ in groups}
+        retired = [id for id in globals.PACKED_RULES if id not in kept]
+        await _modify(delete=replaced + retired)
+        
+        globals.PACKED.clear()
+        globals.PACKED_RULES.clear()
+        for server, members in groups:
+            globals.PACKED[server.id] = tuple(local[rule.id] for rule in members)
+            globals.PACKED_RULES[server.id] = server
+        globals.PACKED_NEEDS.clear()
+        globals.PACKED_NEEDS.update(fields.merge(packing.needs(member.tree) 
+                                                for members in globals.PACKED.values() for member in members))
+        globals.compile_dispatch()
+        if globals.get_stream() is not None:
+            globals.refresh_params()
+        
+        server_rules = len(plan)
+        print("Packed {} rules into {} server rules ({:.1f} rules per server rule)"
+              "".format(len(logical), server_rules, len(logical) / server_rules if server_rules else 0))
+        
+    @Command.command(description="Puts every packed rule back as its own server rule")
+    async def unpack(self):
+        if not globals.PACKED:
+            print("No packed rules")
+            return
+        
+        rules = [globals.get_rule_by_id(id) for id in globals.packed_rule_ids()]
+        copies = [Rule(rules=rule.rules, tag=rule.tag, name=rule.name) for rule in rules]
+        await _modify(add=copies, delete=list(globals.PACKED_RULES.keys()))
+        
+        globals.PACKED.clear()
+        globals.PACKED_RULES.clear()
+        globals.PACKED_NEEDS.clear()
+        for rule, copy in zip(rules, copies):
+            globals.replace_rule_id(rule.id, copy.id)
+        print("Unpacked {} rules".format(len(rules)))
+        
+    @Command.command(description="Makes the server's rules match the local ones in as few requests as possible, "
+                     "options: --pull keeps the server's other rules and adds them locally, --dry-run only shows the difference")
+    async def sync(self, *options):
+        _, options = _split_options(options)
+        server = (await globals.SESSION.get_rules()).get('data', [])
+        changes = sync.diff(globals.server_rules(), server, pull='pull' in options)
+        
+        if 'dry-run' in options:
+            print(changes)
+            return
+        
+        try:
+            requests = 1 + await _push(changes)
+        except InvalidRule as i:
+            print("Couldn't sync, a rule is invalid:")
+            pprint(str(i))
+            return
+        except RulesCapExceeded:
+            print("Rules cap exceeded, delete rules or change bearer token")
+            return
+        for rule in changes.pull:
+            globals.add_rule(rule)
+        print("Synced: {} in {} requests".format(changes, requests))
+        
+    @Command.command(description="Adds the rules of a file, one per line as '<name> <rule> [tag]' like 'rules add', "
+                     "lines starting with # are skipped")
+    async def load(self, file: str):
+        try:
+            with open(file, 'r') as f:
+                lines = [line.strip() for line in f]
+        except FileNotFoundError:
+            print("Couldn't find file: {}".format(file))
+            return
+        
+        known = {normalize(rule.rules) for rule in globals.RULES.values()}
+        loaded = list()
+        for number, line in enumerate(lines, 1):
+            if not line or line.startswith('#'):
+                continue
+            args = list(commands._splinter(line))
+            if len(args) not in (2, 3):
+                print("Line {}: expected '<name> <rule> [tag]'".format(number))
+                return
+            value = normalize(args[1])
+            if value in known:
+                continue
+            known.add(value)
+            loaded.append(Rule(rules=args[1], tag=args[2] if len(args) == 3 else None, name=args[0]))
+        
+        server = (await globals.SESSION.get_rules()).get('data', [])
+        changes = sync.diff(globals.server_rules() + loaded, server, pull=True)
+        try:
+            requests = 1 + await _push(changes)
+        except InvalidRule as i:
+            print("Couldn't load the rules, a rule is invalid and nothing was added:")
+            pprint(str(i))
+            return
+        except RulesCapExceeded:
+            print("Rules cap exceeded, delete rules or change bearer token")
+            return
+        for rule in changes.pull:
+            globals.add_rule(rule)
+        print("Loaded {} rules in {} requests".format(len(loaded), requests))
        
 class handle(commands.CommandGroup):
     
@@ -133,17 +433,53 @@ class handle(commands.CommandGroup):
         self.add_command(self.view)
         self.add_command(self.list)
         self.add_command(self.file)
+        self.add_command(self.pool)
         self.add_group(self.rules())
     
         
-    @Command.command(description="Adds a file output for the stream")
+    @Command.command(description="Adds a file output for the stream, options: --raw writes whole responses, "
+                     "--flush-size=<bytes> --flush-interval=<seconds>, --threaded writes from the writer pool "
+                     "with --queue=<batches> --backpressure=block|drop|spill, --format=plain|gzip|zstd "
+                     "--level=<n> --rotate-size=<bytes, EX: 100M> --rotate-interval=<seconds>, "
+                     "--format=parquet|arrow --row-group=<rows> for columnar files, "
+                     "--fields=<EX: id,text,includes.users.username> to write only those fields, "
+                     "and local filters --keywords=<a,b> --regex=<pattern> --authors=<ids> --exclude-authors=<ids> --lang=<en,es>. "
+                     "The file can be a sink sending to another process: unix:///<path>, tcp://<host>:<port>[?framing=length], "
+                     "fifo:///<path>, redis://<host>:<port>/<list> or zmq+tcp://<host>:<port>, with ?buffer=<bytes>&retry=<seconds>. "
+                     "While streaming, --replay[=<seconds>] first writes the recent tweets kept by 'ring'")
     async def add(self, name: str, file: str, *rules):
-        globals.add_handle(globals.Handle(name, file, rules))
+        rules, options = _split_options(rules)
+        try:
+            kwargs = _handle_kwargs(options)
+            if options.get('replay', True) is not True:
+                try:
+                    since = time.time() - float(options['replay'])
+                except ValueError:
+                    raise ValueError("--replay takes the seconds to replay, EX: --replay=300")
+            _check_output(file, kwargs.get('format', 'plain'), 'rotate_size' in kwargs or 'rotate_interval' in kwargs,
+                          kwargs.get('backpressure'))
+            handle = globals.Handle(name, file, rules, **kwargs)
+        except ValueError as e:
+            print(f"Couldn't add handle: {e}")
+            return
+        globals.add_handle(handle)
         print("Handle added...")
         
+        if 'replay' in options:
+            if globals.RING is None:
+                print("Nothing to replay, keep recent tweets with 'ring set <size>'")
+            elif globals.get_stream() is None:
+                print("Nothing replayed, the handle's file opens when the stream starts")
+            else:
+                print("Replayed {} tweets".format(globals.replay(handle, None if options['replay'] is True else since)))
+        
     @Command.command(description="Delete a handle")
     async def delete(self, name: str):
-        globals.rem_handle(globals.get_handle_by_name(name).id)
+        handle = globals.get_handle_by_name(name)
+        if handle is None:
+            print("Couldn't find handle with name '{}'. Use 'handle list' to see the handles".format(name))
+            return
+        globals.rem_handle(handle.id)
         print('Handle deleted...')
         
     @Command.command(description="View the file handle")
@@ -156,9 +492,15 @@ class handle(commands.CommandGroup):
         
         print("Handle '{}':"
               "\n\tFILE: '{}'"
+              "\n\tFORMAT: {}"
+              "\n\tFIELDS: {}"
+              "\n\tFILTER: {}"
               "\n\tRULES:\t{}"
-              "".format(handle.name, handle.file, ", ".join([f"{globals.get_rule_by_id(id).name}" for id in handle.rules]) \
-                        if handle.rules else 'ALL'))
+              "\n\tWRITER:\t{}{}"
+              "".format(handle.name, handle.file, handle.format, ",".join(handle.fields) if handle.fields else 'ALL', 
+                        handle.predicate if handle.predicate else 'NONE', ", ".join([f"{globals.get_rule_by_id(id).name}" if id in globals.RULES else f"{{{id}}}" for id in handle.rules]) \
+                        if handle.rules else 'ALL', handle.writer.stats if handle.writer else 'not open',
+                        f"\n\tSINK:\t{handle.writer.output.status}" if handle.writer and is_sink(handle.file) else ''))
             
     @Command.command(description="Add a rule to the stream")
     async def list(self):
@@ -167,11 +509,28 @@ class handle(commands.CommandGroup):
             print("\n".join(ls))
         else:
             print('EMPTY')
-    @Command.command(description="Adds a file output for the stream")
+    @Command.command(description="Changes the file or sink of a handle (see 'handle add'), a running stream switches to it")
     async def file(self, name: str, file: str):
-        globals.get_handle_by_name(name).file = file
+        handle = globals.get_handle_by_name(name)
+        if handle is None:
+            print("Couldn't find handle with name '{}'. Use 'handle list' to see the handles".format(name))
+            return
+        try:
+            _check_output(file, handle.format, bool(handle.rotate_size or handle.rotate_interval), handle.backpressure)
+        except ValueError as e:
+            print(f"Couldn't change the file: {e}")
+            return
+        handle.file = file
+        if globals.get_stream() is not None: # what was buffered goes to the old output
+            handle.close_files()
+            handle.open_files()
         print("Updated handle...")
         
+    @Command.command(description="Sets the number of writer threads used by threaded handles")
+    async def pool(self, threads: str):
+        globals.WRITER_THREADS = int(threads)
+        print("Writer pool will use {} threads on the next stream".format(threads))
+        
     class rules(CommandGroup):
         def __init__(self):
             CommandGroup.__init__(self, "Add and Remove Rules from handlers")
@@ -180,39 +539,262 @@ class handle(commands.CommandGroup):
             
         @Command.command(description="Add rules to handle, use delete ALL to receive all")
         async def add(self, name:str, *rules: str):  
-            globals.get_handle_by_name(name).add_rules(rules)
+            handle = globals.get_handle_by_name(name)
+            if handle is None:
+                print("Couldn't find handle with name '{}'. Use 'handle list' to see the handles".format(name))
+                return
+            try:
+                handle.add_rules(rules)
+            except ValueError as e:
+                print(f"Couldn't add the rules: {e}")
+                return
             print("Rule added to handler {}".format(name))
         @Command.command(description="Delete rules from a handle")
         async def delete(self, name:str, *rules: str):
-            globals.get_handle_by_name(name).rem_rules(rules)
+            handle = globals.get_handle_by_name(name)
+            if handle is None:
+                print("Couldn't find handle with name '{}'. Use 'handle list' to see the handles".format(name))
+                return
+            try:
+                handle.rem_rules(rules)
+            except ValueError as e:
+                print(f"Couldn't remove the rules: {e}")
+                return
             print("Rule removed from handler {}".format(name))
             
-@Command.command(description="start streaming to iterators")
-async def stream(handler, hours=0, minutes=0, seconds=0):
-    '''prints stream to handles'''
-    total = (int(hours)*60 + int(minutes))* 60 +int(seconds)
-    stream = await globals.SESSION.stream(total+5)
+def _stop_at_deadline(stream):
+    '''ends a stream started for a duration, unless it was already stopped'''
+    if globals.get_stream() is stream:
+        globals.close()
+        print("\nStream stopped after its duration")
+
+class stream(commands.CommandGroup):
+    '''Runs the stream in the background, handles and rules can change while it runs'''
     
-    # asyncio task is created allowing the program to continue
-    # here and jumps between both coroutines with asyncio.sleep
-    await globals.start(stream) 
+    def __init__(self):
+        CommandGroup.__init__(self, "Starts, stops and shows the stream, which keeps running while other commands are used")
+        self.add_command(self.start)
+        self.add_command(self.stop)
+        self.add_command(self.status)
+        
+    @Command.command(description="start streaming to the handles, reconnecting when the stream drops, "
+                     "[hours minutes seconds] stop it after that long. "
+                     "Options: --stall=<seconds> without data before reconnecting, --backfill=<minutes> to recover on reconnect, "
+                     "--workers=<n> to parse and encode on n processes, --unordered to let their batches finish out of order")
+    async def start(self, *args):
+        if globals.get_stream() is not None:
+            print("Already streaming, use 'stream stop' first")
+            return
+        duration, options = _split_options(args)
+        try:
+            hours, minutes, seconds = (list(map(int, duration)) + [0, 0, 0])[:3]
+            stall, backfill = float(options.get('stall', 30)), int(options.get('backfill', 0))
+            workers = int(options.get('workers', 0))
+        except ValueError:
+            print("Couldn't start: the duration is whole [hours minutes seconds], "
+                  "--stall seconds, --backfill minutes and --workers a count")
+            return
+        total = (hours*60 + minutes)* 60 + seconds
+        
+        if globals.SHARDS:
+            from shards import ShardedStream
+            
+            supervisor = ShardedStream(list(globals.SHARDS.values()), globals.SESSION.base_url, globals.stream_params(),
+                                       placement=globals.SHARD_PLACEMENT, stall_timeout=stall, backfill_minutes=backfill)
+            try:
+                supervisor.start(globals.server_rules())
+            except ValueError as e:
+                print(f"Couldn't start the shards: {e}")
+                return
+        else:
+            supervisor = globals.SESSION.stream(globals.stream_params(), stall_timeout=stall, backfill_minutes=backfill)
+        await globals.start(supervisor, workers=workers, ordered='unordered' not in options)
+        
+        if total:
+            import asyncio
+            
+            asyncio.get_running_loop().call_later(total, _stop_at_deadline, supervisor)
+            print("Streaming for {}s".format(total))
+        else:
+            print("Streaming until 'stream stop'")
+        
+    @Command.command(description="stops the stream, flushing and closing the handles' files")
+    async def stop(self):
+        if globals.get_stream() is None:
+            print("Not streaming")
+            return
+        uptime = globals.uptime()
+        globals.close()
+        print("Stream stopped after {:.0f}s, {} tweets".format(uptime, globals.METRICS.tweets))
+        
+    @Command.command(description="shows whether the stream is connected and how fast it's going")
+    async def status(self):
+        supervisor = globals.get_stream()
+        if supervisor is None:
+            print("Not streaming")
+            return
+        tweets, size = globals.METRICS.rates()
+        print("Stream:"
+              "\n\tCONNECTED: {}"
+              "\n\tUPTIME: {:.0f}s"
+              "\n\tRECONNECTS: {}"
+              "\n\tTWEETS: {} ({:.1f}/s, {:.1f} KB/s)"
+              "\n\tHANDLES: {}"
+              "\n\tPARAMS: {}"
+              "".format(supervisor.connected, globals.uptime(), supervisor.reconnects, globals.METRICS.tweets, 
+                        tweets, size / 1024, len(globals.HANDLES), 
+                        " ".join(f"{param}={values}" for param, values in supervisor.params.items())))
+
+class shard(commands.CommandGroup):
+    '''Splits the rules across several apps, each streaming in its own process'''
     
-    import asyncio
-    import time
+    def __init__(self):
+        CommandGroup.__init__(self, "Streams with several bearer tokens at once, the rules are placed on the shards when the stream starts")
+        self.add_command(self.add)
+        self.add_command(self.delete)
+        self.add_command(self.list)
+        self.add_command(self.placement)
+        
+    @Command.command(description="Adds an app whose bearer token is in the environment variable env, "
+                     "options: --max-rules=<n> it can hold (1000)")
+    async def add(self, name: str, env: str, *args):
+        from shards import Shard, MAX_RULES
+        
+        _, options = _split_options(args)
+        if name in globals.SHARDS:
+            print("Shard {} already exists".format(name))
+            return
+        globals.SHARDS[name] = Shard(name, env, int(options.get('max-rules', MAX_RULES)))
+        print("Shard added, it's used from the next 'stream start'")
+        
+    @Command.command(description="Removes a shard, the rules it held go to the others on the next 'stream start'")
+    async def delete(self, name: str):
+        if globals.SHARDS.pop(name, None) is None:
+            print("Couldn't find shard with name '{}'. Use 'shard list' to see the shards".format(name))
+            return
+        print("Shard deleted...")
+        
+    @Command.command(description="Lists the shards and the rules placed on them when the stream last started")
+    async def list(self):
+        if not globals.SHARDS:
+            print('EMPTY, the stream uses the token it was launched with')
+            return
+        print("Placement: {}".format(globals.SHARD_PLACEMENT))
+        for shard in globals.SHARDS.values():
+            print("\t{}: ${} {}/{} rules".format(shard.name, shard.env, shard.rules, shard.max_rules))
     
-    cycle = itertools.cycle(('|', '/', '—', '\\'))
-    proj_time = time.time() + total
-    while time.time() < proj_time:
+    @Command.command(description="How the rules are placed: balanced evens them out, fill uses a shard up before the next, "
+                     "hash keeps each rule on the same shard across restarts")
+    async def placement(self, policy: str):
+        from shards import PLACEMENTS
         
-        print(next(cycle), end=chr(8))
-        await asyncio.sleep(0.6)
+        if policy not in PLACEMENTS:
+            print("Placement must be one of {}".format(", ".join(PLACEMENTS)))
+            return
+        globals.SHARD_PLACEMENT = policy
+        print("Rules will be placed with {} on the next 'stream start'".format(policy))
+
+class ring(commands.CommandGroup):
+    '''Keeps the recent tweets in memory'''
+    
+    def __init__(self):
+        CommandGroup.__init__(self, "Keeps the most recent tweets in a fixed amount of memory, "
+                              "for 'handle add --replay' and 'tail'")
+        self.add_command(self.set)
+        self.add_command(self.off)
+        self.add_command(self.status)
+        
+    @Command.command(description="Keeps recent tweets in <size> bytes of memory, EX: 64M, the oldest are overwritten first. "
+                     "Options: --max-age=<seconds> to also forget tweets older than that")
+    async def set(self, size: str, *args):
+        from ring import TweetRing
+        
+        _, options = _split_options(args)
+        try:
+            size = _parse_size(size)
+            max_age = float(options['max-age']) if 'max-age' in options else None
+        except ValueError:
+            print("The size and --max-age need numbers, EX: ring set 64M --max-age=600")
+            return
+        globals.RING = TweetRing(size, max_age)
+        print("Keeping the recent tweets in {} bytes".format(size))
+        
+    @Command.command(description="Stops keeping recent tweets and frees their memory")
+    async def off(self):
+        globals.RING = None
+        print("Not keeping recent tweets")
         
-    globals.close() #End
+    @Command.command(description="Shows how many tweets are kept and how old they are")
+    async def status(self):
+        print("Ring: {}".format(globals.RING if globals.RING is not None else 'off'))
+
+@Command.command(description="Shows the newest tweets kept by 'ring', [count] of them (10), only those of [rule] when given")
+async def tail(handler, count: Optional=None, rule: Optional=None):
+    if globals.RING is None:
+        print("No recent tweets are kept, use 'ring set <size>' first")
+        return
+    count = int(count) if count else 10
+    if rule is None:
+        entries = globals.RING.last(count)
+    else:
+        found = globals.get_rule_by_name(rule)
+        if found is None:
+            print("Couldn't find rule with name '{}'. Use 'rules list' to see current rules".format(rule))
+            return
+        entries = [entry for entry in globals.RING.entries() if found.id in entry[1]][-count:]
+    if not entries:
+        print('EMPTY')
+    for received, rule_ids, line in entries:
+        tweet = orjson.loads(line)['data']
+        names = ",".join(globals.RULES[id].name if id in globals.RULES else id for id in rule_ids)
+        text = " ".join(tweet.get('text', '').split())
+        print("{} [{}] {}: {}".format(time.strftime('%H:%M:%S', time.localtime(received)), names, 
+                                      tweet.get('author_id', '?'), text[:100]))
+
+_METRICS_SERVER = None
+
+@Command.command(description="Shows throughput, latency and writer statistics, "
+                 "'stats serve <port>' also exposes them in Prometheus format at http://127.0.0.1:<port>/metrics")
+async def stats(handler, serve: Optional=None, port: Optional=None):
+    global _METRICS_SERVER
+    
+    def render():
+        return metrics.prometheus(globals.METRICS, globals.HANDLES.values(), globals.get_stream())
+    
+    if serve == 'serve':
+        if _METRICS_SERVER is not None:
+            _METRICS_SERVER.close()
+        _METRICS_SERVER = await metrics.serve(render, port=int(port) if port else 9100)
+        print("Serving metrics on port {}".format(port if port else 9100))
+        return
+    
+    m = globals.METRICS
+    tweet_rate, byte_rate = m.rates()
+    silent = m.since(m.last_heartbeat)
+    stream = globals.get_stream()
+    
+    print("Stream:"
+          "\n\t{:.1f} tweets/s, {:.1f} KB/s"
+          "\n\t{} tweets, {} bytes, {} keep-alives, last keep-alive {}"
+          "\n\tparse: {}"
+          "\n\tdispatch: {}"
+          "".format(tweet_rate, byte_rate / 1024, m.tweets, m.bytes, m.heartbeats,
+                    f"{silent:.1f}s ago" if silent is not None else 'never', m.parse, m.dispatch))
+    if stream is not None:
+        print("\t{}, {} reconnects".format('connected' if stream.connected else 'disconnected', stream.reconnects))
+    
+    for handle in globals.HANDLES.values():
+        if handle.writer is not None:
+            print("\t{}: pending {}, {}".format(handle.name, handle.writer.pending, handle.writer.stats))
 
 def setup(handler):
     '''Add all commands to handler'''
     handler.add_group(rules())
     handler.add_group(handle())
-    handler.add_command(stream)
+    handler.add_group(stream())
+    handler.add_group(shard())
+    handler.add_group(ring())
+    handler.add_command(tail)
+    handler.add_command(stats)
 
 
@@ -0,0 +1,116 @@
+'''
+Field selection for handles. A handle's fields, like 'id,text,public_metrics.like_count,includes.users.username',
+compile into a projection function that builds only the selected part of a response, and into the
+request params the stream needs so twitter sends those fields and nothing more
+
+@author: diego
+'''
+from functools import lru_cache
+
+# include kind -> (expansion that produces it, param listing its fields)
+EXPANSIONS = {
+    'users': ('author_id', 'user.fields'),
+    'media': ('attachments.media_keys', 'media.fields'),
+    'places': ('geo.place_id', 'place.fields'),
+    'polls': ('attachments.poll_ids', 'poll.fields'),
+    'tweets': ('referenced_tweets.id', 'tweet.fields'),
+}
+
+# returned without being asked for
+DEFAULT_FIELDS = {'tweet.fields': {'id', 'text', 'edit_history_tweet_ids'}, 'user.fields': {'id', 'name', 'username'},
+                  'media.fields': {'media_key', 'type'}, 'place.fields': {'id', 'full_name'}, 'poll.fields': {'id', 'options'}}
+
+# what handles writing the whole 'data' object have always received
+BASE_PARAMS = {'tweet.fields': {'author_id', 'text'}}
+
+def _pick(source: dict, paths):
+    '''copies the (possibly nested) paths present in source into a new dict'''
+    out = dict()
+    for path in paths:
+        value = source
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = out
+            for key in path[:-1]:
+                target = target.setdefault(key, dict())
+            target[path[-1]] = value
+    return out
+
+class Projection():
+    '''Compiled field selection, shared by every handle with the same fields'''
+    __slots__ = ('fields', 'params', 'project')
+    
+    def __init__(self, fields: tuple):
+        self.fields = fields
+        self.params: dict[str, set] = dict()
+        
+        data_paths = list()
+        include_paths: dict[str, list] = dict()
+        keep_rules = False
+        for field in fields:
+            path = tuple(field.split('.'))
+            match path:
+                case ('matching_rules',):
+                    keep_rules = True
+                case ('includes', kind, *rest) if kind in EXPANSIONS and rest:
+                    expansion, param = EXPANSIONS[kind]
+                    include_paths.setdefault(kind, []).append(tuple(rest))
+                    self._need('expansions', expansion)
+                    self._need(param, rest[0])
+                case ('data', *rest) if rest:
+                    data_paths.append(tuple(rest))
+                    self._need('tweet.fields', rest[0])
+                case ('includes' | 'data', *_):
+                    raise ValueError(f"can't select '{field}', use data.<field> or "
+                                     f"includes.<{'|'.join(EXPANSIONS)}>.<field>")
+                case _:
+                    data_paths.append(path)
+                    self._need('tweet.fields', path[0])
+        
+        data_paths = tuple(data_paths)
+        include_paths = {kind: tuple(paths) for kind, paths in include_paths.items()}
+        
+        def project(response: dict) -> dict:
+            out = _pick(response['data'], data_paths)
+            if include_paths:
+                includes = response.get('includes', {})
+                out['includes'] = {kind: [_pick(item, paths) for item in includes.get(kind, ())] 
+                                   for kind, paths in include_paths.items()}
+            if keep_rules:
+                out['matching_rules'] = response['matching_rules']
+            return out
+        self.project = project
+    
+    def _need(self, param, value):
+        if value not in DEFAULT_FIELDS.get(param, ()):
+            self.params.setdefault(param, set()).add(value)
+
+@lru_cache(maxsize=None)
+def projection(fields: tuple) -> Projection:
+    '''the projection of a tuple of fields, the same object for equal tuples'''
+    return Projection(fields)
+
+def parse(text: str) -> tuple:
+    '''reads a comma separated field list, throws ValueError if a field can't be selected'''
+    fields = tuple(dict.fromkeys(field.strip() for field in text.split(',') if field.strip()))
+    if not fields:
+        raise ValueError("no fields given, EX: --fields=id,text,includes.users.username")
+    projection(fields)
+    return fields
+
+def merge(needs) -> dict:
+    '''union of param needs ({param: set of values})'''
+    merged: dict[str, set] = dict()
+    for need in needs:
+        for param, values in need.items():
+            merged.setdefault(param, set()).update(values)
+    return merged
+
+def stream_params(needs) -> dict:
+    '''merges param needs into the query params of the stream request,
+    with no needs at all the stream asks for BASE_PARAMS'''
+    merged = merge(list(needs) or [BASE_PARAMS])
+    return {param: ",".join(sorted(values)) for param, values in sorted(merged.items()) if values}
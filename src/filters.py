@@ -0,0 +1,96 @@
+'''
+Local filtering of the tweets a handle receives, after they were routed by their server rules.
+The keywords of every handle are matched together, so a tweet's text is scanned once no matter
+how many handles filter on keywords
+
+@author: diego
+'''
+import re
+
+TOKEN = re.compile(r"[#@$]?\w+")
+
+class KeywordMatcher():
+    '''Matches many keywords against a text in one pass. Keywords made of a single word (or
+    #hashtag, @mention, $cashtag) are found by tokenizing the text once and looking the tokens up
+    in a set, so their number doesn't matter. Phrases and keywords with other characters are
+    joined in one regex, longest first, tried at every position so overlapping phrases are found'''
+    
+    def __init__(self, keywords=()):
+        keywords = {keyword.lower() for keyword in keywords if keyword}
+        self.words = frozenset(keyword for keyword in keywords if TOKEN.fullmatch(keyword))
+        self.phrases = tuple(sorted(keywords - self.words, key=len, reverse=True))
+        self._pattern = None
+        self._contained = dict()
+        if self.phrases:
+            alternatives = "|".join(re.escape(phrase) for phrase in self.phrases)
+            self._pattern = re.compile(rf"(?=(?<!\w)({alternatives})(?!\w))")
+            # a shorter phrase starting where a longer one matched is hidden by it, these are added back
+            for phrase in self.phrases:
+                self._contained[phrase] = frozenset(other for other in keywords if other != phrase and 
+                                                    re.search(rf"(?<!\w){re.escape(other)}(?!\w)", phrase))
+    
+    def __bool__(self):
+        return bool(self.words or self.phrases)
+        
+    def match(self, text: str) -> set:
+        '''the keywords found in the text'''
+        text = text.lower()
+        found = set()
+        if self.words:
+            tokens = set(TOKEN.findall(text))
+            tokens.update([token[1:] for token in tokens if not token[0].isalnum() and token[0] != '_'])
+            found = tokens.intersection(self.words)
+        if self._pattern is not None:
+            for phrase in self._pattern.findall(text):
+                found.add(phrase)
+                found.update(self._contained[phrase])
+        return found
+
+class Predicate():
+    '''Local filter of a handle, a tweet passes if every part that was given accepts it'''
+    
+    def __init__(self, keywords=None, regex=None, authors=None, exclude_authors=None, lang=None):
+        self.keywords = frozenset(keyword.lower() for keyword in keywords) if keywords else None # any of them
+        self.regex = re.compile(regex) if regex else None # searched in the text
+        self.authors = frozenset(authors) if authors else None # allowed author ids
+        self.exclude_authors = frozenset(exclude_authors) if exclude_authors else None
+        self.lang = frozenset(lang) if lang else None
+        
+    def needs(self) -> dict:
+        '''tweet fields this predicate reads'''
+        fields = set()
+        if self.keywords or self.regex:
+            fields.add('text')
+        if self.authors or self.exclude_authors:
+            fields.add('author_id')
+        if self.lang:
+            fields.add('lang')
+        return {'tweet.fields': fields - {'text'}} if fields - {'text'} else {}
+    
+    def accepts(self, data: dict, keywords_found) -> bool:
+        '''keywords_found is the KeywordMatcher result for the tweet, needed only when filtering on keywords'''
+        if self.authors is not None and data.get('author_id') not in self.authors:
+            return False
+        if self.exclude_authors is not None and data.get('author_id') in self.exclude_authors:
+            return False
+        if self.lang is not None and data.get('lang') not in self.lang:
+            return False
+        if self.keywords is not None and self.keywords.isdisjoint(keywords_found):
+            return False
+        if self.regex is not None and self.regex.search(data.get('text', '')) is None:
+            return False
+        return True
+    
+    def __str__(self):
+        parts = list()
+        if self.keywords:
+            parts.append(f"keywords {', '.join(sorted(self.keywords))}")
+        if self.regex:
+            parts.append(f"regex {self.regex.pattern}")
+        if self.authors:
+            parts.append(f"authors {', '.join(sorted(self.authors))}")
+        if self.exclude_authors:
+            parts.append(f"not authors {', '.join(sorted(self.exclude_authors))}")
+        if self.lang:
+            parts.append(f"lang {', '.join(sorted(self.lang))}")
+        return "; ".join(parts)
@@ -6,30 +6,88 @@ Also contains a way to map from a rule_id to the handle_ids that suppor it
 '''
 from itertools import count
 from orjson import orjson
+from output.buffer import BufferedWriter
+from output.pool import WriterPool, ThreadedWriter, BLOCK
+from output.files import OutputFile
+from output.sinks import is_sink, open_sink
+from output.columnar import ColumnarOutput, ColumnarWriter, COLUMNAR_FORMATS
+from metrics import StreamMetrics
+import fields as field_selection
+from filters import KeywordMatcher, Predicate
+from net.packing import demux
+from net.utils import Unauthorized
+from registry import Registry, Subscriptions
+from tweet import Tweet
 import asyncio
 import traceback
+import time
 
 SESSION= None
+SHARDS: dict = dict() # name -> Shard, the stream is split across their apps when there are any
+SHARD_PLACEMENT = 'balanced' # how the rules are placed on the shards when the stream starts
 
-RULES_HANDLE: dict[str, list[str]] = dict() # Contains a rule id and the handles that support it
+METRICS = StreamMetrics()
+
+RULES_HANDLE: dict[str, tuple] = dict() # Contains a rule id and the handles that support it
+SUBSCRIPTIONS = Subscriptions() # rule id -> ids of the handles following it, RULES_HANDLE is compiled from it
+_DISPATCH_CACHE: dict[tuple, tuple] = dict() # memo of a combination of rule ids to the handles that support them
+_DISPATCH_VERSION = 0 # changes with every change of RULES_HANDLE
+KEYWORDS = KeywordMatcher() # keywords of every handle's predicate, matched once per tweet
+RING = None # TweetRing of the recent tweets, for replaying them to new handles, None when off
 
 ### HANDLES
-HANDLES=dict()
+HANDLES=Registry()
+
+WRITER_THREADS = 2 # size of the pool shared by threaded handles
+_WRITER_POOL: WriterPool = None
+
+def get_writer_pool() -> WriterPool:
+    '''creates the writer pool on first use'''
+    global _WRITER_POOL
+    if _WRITER_POOL is None:
+        _WRITER_POOL = WriterPool(WRITER_THREADS)
+    return _WRITER_POOL
 
 class Handle():
-    '''Object for a file output as well as what rules it should pull'''
+    '''Object for a file or sink output as well as what rules it should pull'''
     iterator = count() # for handle id to make inter-relational datastructures lighter
     
-    def __init__(self, name, file, rules=None): 
+    def __init__(self, name, file, rules=None, raw=False, flush_size=1 << 16, flush_interval=None,
+                 threaded=False, backpressure=BLOCK, max_batches=64, format='plain', level=None,
+                 rotate_size=None, rotate_interval=None, row_group_size=10000, fields=None, 
+                 predicate: Predicate=None, rule_ids=None): 
         self.name = name
         self.file = file
-        self.__rules = list() if not rules else [get_rule_by_name(rule).id for rule in rules]
+        self.raw = raw # write the response line as received instead of only its 'data' object
+        self.flush_size = flush_size # bytes held before the writer flushes
+        self.flush_interval = flush_interval # seconds before buffered lines are flushed anyway, None for the writer's default
+        self.threaded = threaded # write from the writer pool instead of the event loop
+        self.backpressure = backpressure # policy when max_batches flushes are waiting on the pool
+        self.max_batches = max_batches
+        self.format = format # 'plain', 'gzip' or 'zstd', or the columnar 'parquet' and 'arrow'
+        self.level = level # compression level, None for the format's default
+        self.rotate_size = rotate_size # bytes on disk before starting a new file
+        self.rotate_interval = rotate_interval # seconds before starting a new file
+        self.row_group_size = row_group_size # rows per record batch of columnar formats
+        self.fields = fields # tuple of selected fields, None writes the whole 'data' object
+        self.projection = field_selection.projection(fields) if fields else None
+        self.predicate = predicate # local filter applied after the rules routed a tweet here
+        # rule_ids are taken as they are, a restored handle keeps following rules deleted since
+        self.__rules = set(rule_ids) if rule_ids else self._ids(rules or ())
         self.__id=next(self.iterator)
-        self.open_file=None
+        self.writer=None
+    
+    @staticmethod
+    def _ids(names) -> set:
+        '''ids of the rules named, throws ValueError for a name that isn't a rule'''
+        unknown = [name for name in names if not RULES.has_name(name)]
+        if unknown:
+            raise ValueError("no rule named {}, use 'rules list' to see the rules".format(", ".join(unknown)))
+        return {get_rule_by_name(name).id for name in names}
     
     @property
     def rules(self):
-        '''list of rule ids'''
+        '''set of rule ids'''
         return self.__rules
     
     @property
@@ -37,142 +95,439 @@ class Handle():
         '''id of handle itself'''
         return self.__id
     
+    def needs(self) -> dict:
+        '''the stream request params this handle needs'''
+        if self.projection is None or self.raw or self.columnar:
+            needs = field_selection.BASE_PARAMS
+        else:
+            needs = self.projection.params
+        if self.predicate is not None:
+            return field_selection.merge([needs, self.predicate.needs()])
+        return needs
+    
+    @property
+    def columnar(self):
+        '''columnar handles take parsed tweets instead of encoded lines'''
+        return self.format in COLUMNAR_FORMATS
+    
     def add_rules(self, rules):
         '''add rules by name to handle'''
-        for rule in rules:
-            rule_id = get_rule_by_name(rule).id
-            if rule_id not in self.__rules:
-                self.__rules.append(rule_id)
+        added = self._ids(rules) - self.__rules
+        if not added:
+            return
+        was_all = not self.__rules
+        self.__rules.update(added)
+        if self.id in HANDLES:
+            if was_all:
+                SUBSCRIPTIONS.unfollow(self.id, ())
+            SUBSCRIPTIONS.follow(self.id, added)
+            update_dispatch(None if was_all else added)
                 
     def rem_rules(self, rules):
         '''remove rules by name from handle'''
+        removed = self._ids(rules) & self.__rules
+        if not removed:
+            return
+        self.__rules.difference_update(removed)
+        if self.id in HANDLES:
+            SUBSCRIPTIONS.unfollow(self.id, removed)
+            if not self.__rules:
+                SUBSCRIPTIONS.follow(self.id, ())
+            update_dispatch(None if not self.__rules else removed)
         
-        for rule in rules:
-            rule_id = get_rule_by_name(rule).id
-            if rule_id in self.__rules:
-                self.__rules.remove(rule_id)
+    def _replace_rule(self, old, new):
+        '''follows a rule whose id changed'''
+        if old in self.__rules:
+            self.__rules.discard(old)
+            self.__rules.add(new)
         
     def open_files(self):
-        '''Opens up the file object for writing'''
-        self.open=open(self.file, 'w', encoding="utf-8")
+        '''Opens up the writer of the file'''
+        if self.columnar:
+            self.writer = ColumnarWriter(ColumnarOutput(self.file, self.format), get_writer_pool(), self.row_group_size,
+                                         self.flush_interval or 60.0, self.backpressure, self.max_batches)
+            self.writer.open()
+            return
+        
+        if is_sink(self.file):
+            output = open_sink(self.file)
+        else:
+            output = OutputFile(self.file, self.format, self.level, self.rotate_size, self.rotate_interval)
+        
+        if self.threaded or self.format != 'plain': # compression is kept off the event loop
+            self.writer = ThreadedWriter(output, get_writer_pool(), self.flush_size, self.flush_interval or 1.0,
+                                         self.backpressure, self.max_batches)
+        else:
+            self.writer = BufferedWriter(output, self.flush_size, self.flush_interval or 1.0)
+        self.writer.open()
         
     def close_files(self):
-        '''closes and releases file object'''
-        self.open.close()
+        '''flushes, closes and releases the writer'''
+        if self.writer is not None:
+            self.writer.close()
+        
+    def write(self, line: bytes):
+        '''buffer an encoded line, already ending in a newline'''
+        self.writer.write(line)
         
-    def write(self, text):
-        '''write a line of text'''
-        self.open.write(text)
-        self.open.write("\n")
+    def append(self, tweet: dict, matching_rules: list, received: float, size: int):
+        '''add a parsed tweet to a columnar handle'''
+        self.writer.append(tweet, matching_rules, received, size)
+        
+    def tick(self):
+        '''lets the writer flush on time when no tweets are arriving'''
+        self.writer.tick()
 
 def add_handle(handle: Handle):
-    HANDLES[handle.id] = handle
+    if _STREAM is not None: # added while streaming
+        handle.open_files()
+    HANDLES.add(handle)
+    if _STREAM is not None:
+        refresh_params()
+    SUBSCRIPTIONS.follow(handle.id, handle.rules)
+    update_dispatch(handle.rules or None)
+    if handle.predicate is not None and handle.predicate.keywords:
+        compile_keywords()
     
 def rem_handle(id: str):
-    del HANDLES[id]
+    handle = HANDLES.remove(id)
+    if _STREAM is not None:
+        handle.close_files()
+        refresh_params()
+    SUBSCRIPTIONS.unfollow(id, handle.rules)
+    update_dispatch(handle.rules or None)
+    if handle.predicate is not None and handle.predicate.keywords:
+        compile_keywords()
     
 def get_handle_by_id(id):
     '''get's handle by id'''
-    if id in HANDLES.keys():
-        return HANDLES[id]
-    else:
-        return None
+    return HANDLES.get(id)
     
 def get_handle_by_name(name):
     '''retrieves handle by name'''
-    for handle in HANDLES.values():
-        if handle.name == name:
-            return handle
-    return None
+    return HANDLES.by_name(name)
 
 
 ### RULES
-RULES = dict()
+RULES = Registry()
 
 def add_rule(rule):
-    for x in RULES.values():
-        if x.name == rule.name:
-            rule.name+='(1)'
-    
-    if rule.id in RULES.keys():    
-        x.name=rule.name
-        x.value=rule.value
-        x.tag = rule.tag
+    existing = RULES.get(rule.id) if rule.id is not None else None
+    if existing is not None:
+        if existing.name != rule.name and not RULES.has_name(rule.name):
+            RULES.rename(existing.id, rule.name)
+        existing.rules = rule.rules
+        existing.tag = rule.tag
         return
     
-    RULES[rule.id] = rule
+    while RULES.has_name(rule.name):
+        rule.name+='(1)'
+    
+    RULES.add(rule)
+    update_dispatch([rule.id])
     
 def rem_rule(id):
-    pass
+    '''forgets a rule, the handles following it keep its id so they don't fall back to every tweet'''
+    if id in RULES:
+        RULES.remove(id)
+        update_dispatch([id])
 
 def get_rule_by_name(name):
-    for x in RULES.values():
-        if x.name == name:
-            return x
-    
-    return None
+    return RULES.by_name(name)
 
 def get_rule_by_id(id):
-    if id in RULES.keys():
-        return RULES[id]
-    return None
+    return RULES.get(id)
+
+def replace_rule_id(old, new):
+    '''gives a rule a new id, keeping the handles that use it'''
+    RULES.reid(old, new)
+    for handle_id in SUBSCRIPTIONS.by_rule.get(old, ()):
+        HANDLES[handle_id]._replace_rule(old, new)
+    SUBSCRIPTIONS.reid(old, new)
+    RULES_HANDLE.pop(old, None)
+    update_dispatch([new])
+
+### PACKING
+PACKED: dict[str, tuple] = dict() # packed server rule id -> LogicalRules matched locally
+PACKED_RULES: dict = dict() # packed server rule id -> its Rule
+PACKED_NEEDS: dict = dict() # stream params the local matching reads
+
+def packed_rule_ids():
+    '''ids of the rules that only exist inside packed server rules'''
+    return {member.id for members in PACKED.values() for member in members}
+
+def server_rules() -> list:
+    '''the rules the server should have: the unpacked rules and the packed ones standing for the rest'''
+    packed = packed_rule_ids()
+    return [rule for rule in RULES.values() if rule.id not in packed] + list(PACKED_RULES.values())
+
+### DISPATCH
+def _handles_for_rule(rule_id):
+    '''tuple of handles that want tweets from a rule, handles without rules want everything'''
+    return tuple(HANDLES[handle_id] for handle_id in SUBSCRIPTIONS.handles(rule_id))
+
+def dispatch_version():
+    '''lets copies of the dispatch table (like the worker pipeline's) know when they're stale'''
+    return _DISPATCH_VERSION
+
+def compile_keywords():
+    '''compiles the keywords of the handles' predicates'''
+    global _DISPATCH_VERSION, KEYWORDS
+    _DISPATCH_VERSION += 1
+    KEYWORDS = KeywordMatcher(keyword for handle in HANDLES.values() 
+                              if handle.predicate is not None and handle.predicate.keywords
+                              for keyword in handle.predicate.keywords)
+
+def compile_dispatch():
+    '''Maps every rule id to the tuple of handles that support it in RULES_HANDLE
+    from the subscriptions, only needed when most entries changed at once'''
+    global _DISPATCH_VERSION
+    _DISPATCH_VERSION += 1
+    _DISPATCH_CACHE.clear()
+    RULES_HANDLE.clear()
+    for rule_id in RULES.keys():
+        RULES_HANDLE[rule_id] = _handles_for_rule(rule_id)
+
+def update_dispatch(rule_ids=None):
+    '''Recomputes the entries of the given rule ids, or every entry when None.
+    The memo cache is dropped since any combination could contain a changed rule'''
+    if rule_ids is None:
+        compile_dispatch()
+        return
+    
+    global _DISPATCH_VERSION
+    _DISPATCH_VERSION += 1
+    for rule_id in rule_ids:
+        if rule_id in RULES:
+            RULES_HANDLE[rule_id] = _handles_for_rule(rule_id)
+        else:
+            RULES_HANDLE.pop(rule_id, None)
+    _DISPATCH_CACHE.clear()
+
+def dispatch(rule_ids: tuple) -> tuple:
+    '''returns the handles for a combination of matching rule ids, each handle once'''
+    handles = _DISPATCH_CACHE.get(rule_ids)
+    if handles is None:
+        merged = dict()
+        for rule_id in rule_ids:
+            for handle in RULES_HANDLE.get(rule_id, ()):
+                merged[handle.id] = handle
+        handles = _DISPATCH_CACHE[rule_ids] = tuple(merged.values())
+    return handles
 
 ### GENERAL: 
 __RUNNING=False
+_STREAM = None # StreamSupervisor or ShardedStream being read
+_PIPELINE = None # worker processes, when streaming with them
+_STARTED = None # monotonic time the stream started
+_CLOSED: asyncio.Event = None # set when the stream is closed
+_STOP_REQUESTED = False # set by a signal or a deadline, the script being run finishes early
+_UNAUTHORIZED = False # set when the stream's token was refused, the script being run ends with it
+
+def request_stop():
+    '''stops the stream and the script being run, safe to call from a signal handler of the loop'''
+    global _STOP_REQUESTED
+    _STOP_REQUESTED = True
+    if _STREAM is not None:
+        close()
+    
+def stop_requested() -> bool:
+    return _STOP_REQUESTED
+
+def stream_unauthorized():
+    '''closes the stream when twitter stops accepting the token, the reconnects would be refused too'''
+    global _UNAUTHORIZED
+    _UNAUTHORIZED = True
+    print("\nStream closed, the bearer token was refused")
+    request_stop()
+    
+def unauthorized() -> bool:
+    return _UNAUTHORIZED
 
 async def process_tweets(stream):
-    ''' Waits for input from response stream, closing stream and returning when _RUNNING is False'''
+    ''' Waits for batches of lines from the supervised stream, stopping it and returning when __RUNNING is False'''
+    recent = stream.recent # None when tweets can't arrive twice
+    delivered = stream.delivered # set when several shards can deliver a tweet
     try:
-        async for raw_response in stream.content:
-            if raw_response.strip():
+        async for lines in stream.batches():
+            if not __RUNNING:
+                stream.stop()
+                return
+            
+            for raw_response in lines:
+                if raw_response.strip():
                 
-                response=orjson.loads(raw_response)
+                    parsed = time.perf_counter()
+                    tweet = Tweet(raw_response) # only the matching rules are read, the rest when something needs it
+                    start = time.perf_counter()
+                    if not tweet.is_tweet: # twitter reports problems with the connection in-band
+                        print(f"\nStream error: {tweet.errors}")
+                        continue
+                    if recent is not None and recent.seen(tweet.id):
+                        continue
                 
-                handle_ls=list()
-                for rule in response['matching_rules']:
-                    if rule['id'] in RULES_HANDLE.keys():
-                        handle_ls.extend(RULES_HANDLE[rule['id']])
+                    matching = tweet.matching
+                    if PACKED:
+                        matching = demux(matching, tweet.response, PACKED)
+                    if len(matching) == 1: # common case skips building a key
+                        handles = RULES_HANDLE.get(matching[0]['id'], ())
+                    else:
+                        handles = dispatch(tuple([rule['id'] for rule in matching]))
+                    if delivered is not None:
+                        tweet_id = tweet.id
+                        handles = [handle for handle in handles if delivered.first(tweet_id, handle.id)]
                 
-                tweet = response['data']
-                for handle in set(handle_ls):
-                    if not __RUNNING:
-                        stream.close()
-                        await stream.release()
+                    received = None
+                    if RING is not None:
+                        received = time.time()
+                        RING.append(raw_response.rstrip(), [rule['id'] for rule in matching], received)
+                    
+                    # encoded at most once per tweet and shared by every handle
+                    data = None
+                    raw = None
+                    projected = None # projection -> line
+                    found = None # keywords in the text
+                    for handle in handles:
+                        predicate = handle.predicate
+                        if predicate is not None:
+                            if found is None and predicate.keywords is not None:
+                                found = KEYWORDS.match(tweet.data.get('text', ''))
+                            if not predicate.accepts(tweet.data, found):
+                                continue
                         
-                        return
-                    get_handle_by_id(handle).write(orjson.dumps(tweet).decode("utf-8"))
+                        if handle.columnar:
+                            if received is None:
+                                received = time.time()
+                            handle.append(tweet.data, matching, received, len(raw_response))
+                        elif handle.raw:
+                            if raw is None:
+                                raw = raw_response.rstrip() + b"\n"
+                            handle.write(raw)
+                        elif handle.projection is not None:
+                            if projected is None:
+                                projected = dict()
+                            line = projected.get(handle.projection)
+                            if line is None:
+                                line = projected[handle.projection] = orjson.dumps(handle.projection.project(tweet.response), 
+                                                                                   option=orjson.OPT_APPEND_NEWLINE)
+                            handle.write(line)
+                        else:
+                            if data is None:
+                                data = orjson.dumps(tweet.data, option=orjson.OPT_APPEND_NEWLINE)
+                            handle.write(data)
+                    METRICS.tweet(len(raw_response), start - parsed, time.perf_counter() - start)
+                else: # keep-alive
+                    METRICS.heartbeat(len(raw_response))
+                    for handle in HANDLES.values():
+                        handle.tick()
             await asyncio.sleep(0)
+    except Unauthorized:
+        stream_unauthorized()
     except Exception:
-        traceback.print_exc() 
-
+        traceback.print_exc()
         
-async def start(stream):
-    '''First maps our rule_id and corresponding handle_ids in RULES_HANLDES
-    Then it start process_tweets in a task
+async def start(stream, workers=0, ordered=True):
+    '''Opens the handles' files, RULES_HANDLE is already kept up to date by every change.
+    Then it start process_tweets in a task reading from the StreamSupervisor,
+    or a Pipeline of worker processes when workers is given
     '''
-    for rule_id in RULES.keys():
-        RULES_HANDLE[rule_id]=[]
-    
     for handle in HANDLES.values():
         handle.open_files()
-        
-        for rule in handle.rules:
-            RULES_HANDLE[rule].append(handle.id)
-            
-        if not handle.rules:
-            for value in RULES_HANDLE.values():
-                value.append(handle.id)
-    global __RUNNING, work_thread 
+    
+    global __RUNNING, _STREAM, _PIPELINE, _STARTED, _CLOSED
     __RUNNING=True
-    asyncio.get_event_loop().create_task(process_tweets(stream))
+    _STREAM = stream
+    _STARTED = time.monotonic()
+    _CLOSED = asyncio.Event()
+    if workers:
+        from pipeline import Pipeline
+        
+        _PIPELINE = Pipeline(workers, ordered)
+        asyncio.get_event_loop().create_task(_PIPELINE.run(stream, lambda: __RUNNING))
+    else:
+        asyncio.get_event_loop().create_task(process_tweets(stream))
+    asyncio.get_event_loop().create_task(METRICS.sampler(lambda: __RUNNING))
+    
     
+def replay(handle: Handle, since: float = None) -> int:
+    '''writes the tweets of RING received after since that the handle would have been sent,
+    returns how many it got'''
+    delivered = _STREAM.delivered if _STREAM is not None else None
+    sent = 0
+    for received, rule_ids, line in RING.entries(since):
+        if handle.rules and handle.rules.isdisjoint(rule_ids):
+            continue
+        tweet = Tweet(line)
+        if delivered is not None and not delivered.first(tweet.id, handle.id):
+            continue
+        predicate = handle.predicate
+        if predicate is not None:
+            found = KEYWORDS.match(tweet.data.get('text', '')) if predicate.keywords is not None else None
+            if not predicate.accepts(tweet.data, found):
+                continue
+        
+        if handle.columnar:
+            matching = demux(tweet.matching, tweet.response, PACKED) if PACKED else tweet.matching
+            handle.append(tweet.data, matching, received, len(line))
+        elif handle.raw:
+            handle.write(line + b"\n")
+        elif handle.projection is not None:
+            handle.write(orjson.dumps(handle.projection.project(tweet.response), option=orjson.OPT_APPEND_NEWLINE))
+        else:
+            handle.write(orjson.dumps(tweet.data, option=orjson.OPT_APPEND_NEWLINE))
+        sent += 1
+    return sent
+
+def stream_params() -> dict:
+    '''query params of the stream, the union of what every handle needs'''
+    needs = [handle.needs() for handle in HANDLES.values()]
+    if PACKED_NEEDS:
+        needs.append(PACKED_NEEDS)
+    return field_selection.stream_params(needs)
+
+def refresh_params():
+    '''the next connection asks for what the handles need now, the open one keeps its params
+    since reconnecting loses tweets and counts against the connection limits'''
+    params = stream_params()
+    current = {param: set(values.split(",")) for param, values in _STREAM.params.items()}
+    missing = [f"{param}={value}" for param, values in params.items() 
+               for value in values.split(",") if value not in current.get(param, ())]
+    _STREAM.params = params
+    if missing:
+        print("The stream will ask for {} when it reconnects".format(", ".join(missing)))
+
+def get_stream():
+    '''the StreamSupervisor or ShardedStream being read, None when not streaming'''
+    return _STREAM
+
+def uptime():
+    '''seconds since the stream started, None when not streaming'''
+    return None if _STREAM is None else time.monotonic() - _STARTED
+
+async def wait_closed():
+    '''returns once the stream running is closed'''
+    if _STREAM is not None:
+        await _CLOSED.wait()
     
 def close():
     '''closes the streaming operations'''
-    global __RUNNING
+    global __RUNNING, _STREAM, _PIPELINE
     __RUNNING = False
+    if _STREAM is not None:
+        _STREAM.stop()
+        _STREAM = None
+    if _PIPELINE is not None: # the batches still in the workers are written before the files close
+        _PIPELINE.close()
+        _PIPELINE = None
     for handle in HANDLES.values():
         handle.close_files()
     
+    global _WRITER_POOL
+    if _WRITER_POOL is not None:
+        _WRITER_POOL.close()
+        _WRITER_POOL = None
+    if _CLOSED is not None:
+        _CLOSED.set()
+    
         
         
\ No newline at end of file
@@ -1,19 +1,38 @@
 '''
 Created on Oct 18, 2022
 
+Without arguments the commands are read from the console. With -f they're read from a
+script and run without a console, for unattended captures:
+
+    BEARER_TOKEN=... python main.py -f capture.txt --duration 3600
+
+SIGTERM or SIGINT stop the stream, flush and close the files. The exit code is 0 when
+the script ran, 1 when a command failed, 2 for a bad script and 3 for a rejected token
+
 @author: diego
 '''
-from sys import argv
+import argparse
 import getpass
+import signal
 import sys
 import os
 import asyncio
+import queue
+import threading
+import traceback
 import globals
 from typing import Any
 from net import utils
-from command.commands import Handler
+from command import commands
+from command.commands import Handler, CommandGroup
 from command import basic_commands
 from net.utils import Unauthorized
+import state
+
+EXIT_OK = 0
+EXIT_FAILED = 1 # a command of the script raised
+EXIT_SCRIPT = 2 # the script couldn't be read or has unknown commands
+EXIT_UNAUTHORIZED = 3
 
 
 
@@ -22,6 +41,33 @@ def dec_input() -> Any:
     print(">>>>>>>> ", end = "")
     return input()
 
+class Console():
+    '''Reads the console on a daemon thread, so the event loop (and the stream) keeps running
+    while the prompt waits. A line is only read when asked for, so the prompt comes after the
+    output of the previous command'''
+    
+    def __init__(self, loop):
+        self._loop = loop
+        self._requests = queue.SimpleQueue()
+        threading.Thread(target=self._read, name='console', daemon=True).start()
+        
+    def _read(self):
+        while True:
+            future = self._requests.get()
+            try:
+                line = dec_input()
+            except EOFError:
+                line = None
+            self._loop.call_soon_threadsafe(future.set_result, line)
+            if line is None:
+                return
+            
+    async def input(self):
+        '''the next line, None when the console was closed'''
+        future = self._loop.create_future()
+        self._requests.put(future)
+        return await future
+
 def get_bearer_token()-> str:
     '''Asks for bearer_tokens'''
     print("Use help for info\n"
@@ -40,38 +86,134 @@ def get_bearer_token()-> str:
     return inp
 
 
-async def start(bearer_token: str):
+def commands_handler() -> Handler:
+    handle = Handler() 
+    basic_commands.setup(handle)
+    return handle
+
+async def connect(bearer_token: str, state_path: str=None, base_url=utils.API_URL):
+    '''opens the session, restores the saved state and synchronizes the rules'''
+    globals.SESSION = await utils.TwitterSession(bearer_token, base_url)
+    
+    # the rules fetched to validate the token tell whether the saved state is still what the server has
+    server = globals.SESSION.initial_rules.get('data', [])
+    if state_path is None or state.load(state_path) != state.fingerprint(server):
+        await basic_commands.sync_rules(server) #IMPORTANT: synchronize the rules that twitter has
+        if state_path is not None:
+            state.save(state_path)
+
+async def start(bearer_token: str, state_path: str=state.DEFAULT_PATH, base_url=utils.API_URL):
     '''The start coroutine to begin all the asynchronous function'''
     print("Ready")
     
-    globals.SESSION = await utils.TwitterSession(bearer_token)
-    handle = Handler() 
-    basic_commands.setup(handle)
-    await basic_commands.sync_rules() #IMPORTANT: synchronize the rules that twitter has
+    handle = commands_handler()
+    await connect(bearer_token, state_path, base_url)
     
-    while not globals.SESSION.closed:
-        await handle._handle(dec_input())
-        print()
+    console = Console(asyncio.get_running_loop())
+    try:
+        while not globals.SESSION.closed:
+            line = await console.input()
+            if line is None:
+                break
+            try:
+                await handle._handle(line)
+            except Exception: # a failed command doesn't end the session, the stream keeps running behind it
+                traceback.print_exc()
+            state.save(state_path)
+            print()
+    finally: # ctrl-c included, the handles are flushed and closed
+        globals.request_stop()
+        
+def read_script(path: str, handler: Handler) -> list:
+    '''the command lines of a script, blank lines and lines starting with # are skipped.
+    Every line is checked to name a command before any runs, so a typo doesn't end a capture halfway'''
+    with open(path, 'r') as f:
+        lines = [(number, line.strip()) for number, line in enumerate(f, 1)]
+    lines = [(number, line) for number, line in lines if line and not line.startswith('#')]
+    
+    unknown = list()
+    for number, line in lines:
+        node = handler
+        for token in commands._splinter(line):
+            if token not in node.commands:
+                unknown.append(f"line {number}: unknown command '{token}'")
+                break
+            node = node.commands[token]
+            if not isinstance(node, CommandGroup):
+                break
+    if unknown:
+        raise ValueError("\n".join(unknown))
+    return lines
+
+async def run_script(args) -> int:
+    '''runs the commands of a script without a console, returns the exit code'''
+    token = os.environ.get(args.token_env)
+    if not token:
+        print("Set the bearer token in the {} environment variable".format(args.token_env))
+        return EXIT_UNAUTHORIZED
+    
+    handle = commands_handler()
+    try:
+        lines = read_script(args.file, handle)
+    except (FileNotFoundError, ValueError) as e:
+        print("Couldn't run script {}: {}".format(args.file, e))
+        return EXIT_SCRIPT
+    
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, globals.request_stop)
+    if args.duration:
+        loop.call_later(args.duration, globals.request_stop)
+    
+    try:
+        await connect(token, args.state, args.base_url)
+    except Unauthorized:
+        print("Couldn't get authorized with the Bearer Token in {}".format(args.token_env))
+        return EXIT_UNAUTHORIZED
+    except utils.RequestFailed as e:
+        print("Couldn't read the rules of the server: {}".format(e))
+        if globals.SESSION is not None and not globals.SESSION.closed:
+            await globals.SESSION.close()
+        return EXIT_FAILED
+    
+    code = EXIT_OK
+    try:
+        for number, line in lines:
+            if globals.stop_requested():
+                break
+            print(">>>>>>>> {}".format(line))
+            await handle._handle(line)
+            if args.state is not None:
+                state.save(args.state)
+        await globals.wait_closed() # a stream the script started runs until its duration, --duration or a signal
+        if globals.unauthorized():
+            code = EXIT_UNAUTHORIZED
+    except Exception:
+        traceback.print_exc()
+        code = EXIT_FAILED
+    finally:
+        if globals.get_stream() is not None: # flushes what a failed stream command left buffered
+            globals.close()
+        await globals.SESSION.close()
+    return code
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Streams the Twitter filtered stream into files")
+    parser.add_argument('-f', '--file', help="script of commands to run without a console")
+    parser.add_argument('--token-env', default='BEARER_TOKEN', 
+                        help="environment variable holding the bearer token when running a script")
+    parser.add_argument('--duration', type=float, default=0, 
+                        help="seconds before a script is stopped, 0 to run until it ends or is signaled")
+    parser.add_argument('--base-url', default=utils.API_URL, help="API to connect to, like the local fake API")
+    parser.add_argument('--state', default=None, 
+                        help=f"state file of the rules and handles, '{state.DEFAULT_PATH}' for the console, none for scripts")
+    return parser.parse_args(argv)
         
 if __name__ == '__main__':
+    args = parse_args()
 
-    if len(argv)>1:
-        '''This is meant for file input of a script. TODO'''
-        try:
-            x=argv.index('-f')
-            if len(argv) <= x+1:
-                print("Use the -f flag before your file arguments")
-                exit()
-            
-            path=argv[x+1]
-            try:
-                open(path, 'r')
-                #TODO
-            except FileNotFoundError:
-                print("Couldn't find file: {}".format(path))
-        except ValueError as e:
-            print("Use the -f flag before your file arguments")
-            exit()
+    if args.file:
+        sys.exit(asyncio.run(run_script(args)))
             
     else:
         def try_bearer_token():
@@ -79,7 +221,7 @@ if __name__ == '__main__':
             try:
                 bearer_token = get_bearer_token()
                 print("Loading bearer token\n")
-                asyncio.run(start(bearer_token))
+                asyncio.run(start(bearer_token, args.state or state.DEFAULT_PATH, args.base_url))
             except Unauthorized:
                 print("Couldn't get authorized with Bearer Token, Try again")
                 try_bearer_token()
@@ -0,0 +1,186 @@
+'''
+Throughput, liveness and latency metrics of the stream pipeline, readable with the
+'stats' command or scraped in Prometheus text format from a small local HTTP endpoint
+
+@author: diego
+'''
+from bisect import bisect_left
+from collections import deque
+import asyncio
+import time
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+
+class Latency():
+    '''Histogram of durations with fixed buckets'''
+    
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+            
+    def quantile(self, q):
+        '''upper bound of the bucket holding the q quantile'''
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+    
+    def __str__(self):
+        return f"p50 {self.quantile(0.5)*1e6:.0f}us, p99 {self.quantile(0.99)*1e6:.0f}us, max {self.max*1e6:.0f}us"
+
+class StreamMetrics():
+    '''Counters updated by process_tweets, and a sampler that turns them into rates'''
+    
+    def __init__(self, window=10):
+        self.tweets = 0
+        self.bytes = 0
+        self.heartbeats = 0
+        self.last_line = None # monotonic time of the last line of any kind
+        self.last_heartbeat = None
+        self.parse = Latency()
+        self.dispatch = Latency()
+        self.stall_warning = 25.0 # seconds without a line before warning, keep-alives come every 20
+        self._samples = deque(maxlen=window + 1) # (time, tweets, bytes) once per second
+        self._warned = False
+        
+    def tweet(self, size, parse_seconds, dispatch_seconds):
+        self.tweets += 1
+        self.bytes += size
+        self.last_line = time.monotonic()
+        self.parse.record(parse_seconds)
+        self.dispatch.record(dispatch_seconds)
+        
+    def batch(self, tweets, size, parse_seconds, dispatch_seconds):
+        '''a batch from the worker pipeline, parse_seconds is the time spent in the worker and
+        dispatch_seconds the time spent writing on the loop, recorded as one per-tweet average each'''
+        if not tweets:
+            return
+        self.tweets += tweets
+        self.bytes += size
+        self.last_line = time.monotonic()
+        self.parse.record(parse_seconds / tweets)
+        self.dispatch.record(dispatch_seconds / tweets)
+        
+    def heartbeat(self, size):
+        self.heartbeats += 1
+        self.bytes += size
+        self.last_line = self.last_heartbeat = time.monotonic()
+        
+    def since(self, moment):
+        '''seconds since a monotonic time, None if it never happened'''
+        return None if moment is None else time.monotonic() - moment
+    
+    def rates(self):
+        '''(tweets/sec, bytes/sec) over the sampled window'''
+        if len(self._samples) < 2:
+            return 0.0, 0.0
+        (t0, tweets0, bytes0), (t1, tweets1, bytes1) = self._samples[0], self._samples[-1]
+        elapsed = t1 - t0
+        return (tweets1 - tweets0) / elapsed, (bytes1 - bytes0) / elapsed
+    
+    async def sampler(self, running):
+        '''samples the counters every second and warns once per stall while running() is True'''
+        while running():
+            self._samples.append((time.monotonic(), self.tweets, self.bytes))
+            
+            silent = self.since(self.last_line)
+            if silent is not None and silent > self.stall_warning:
+                if not self._warned:
+                    print(f"\nWarning: nothing received from the stream for {silent:.0f}s")
+                    self._warned = True
+            else:
+                self._warned = False
+            await asyncio.sleep(1)
+
+def _histogram(lines, name, latency: Latency):
+    lines.append(f"# TYPE {name} histogram")
+    seen = 0
+    for bound, n in zip(BUCKETS, latency.counts):
+        seen += n
+        le = "+Inf" if bound == float('inf') else repr(bound)
+        lines.append(f'{name}_bucket{{le="{le}"}} {seen}')
+    lines.append(f"{name}_sum {latency.total}")
+    lines.append(f"{name}_count {latency.count}")
+    
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus(metrics: StreamMetrics, handles, stream=None) -> str:
+    '''renders the metrics, the writers of the handles and the supervisor in Prometheus text format'''
+    lines = list()
+    
+    def metric(name, kind, value):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+        
+    metric("twitter_stream_tweets_total", "counter", metrics.tweets)
+    metric("twitter_stream_bytes_total", "counter", metrics.bytes)
+    metric("twitter_stream_heartbeats_total", "counter", metrics.heartbeats)
+    silent = metrics.since(metrics.last_line)
+    if silent is not None:
+        metric("twitter_stream_seconds_since_last_line", "gauge", f"{silent:.3f}")
+    since_heartbeat = metrics.since(metrics.last_heartbeat)
+    if since_heartbeat is not None:
+        metric("twitter_stream_seconds_since_heartbeat", "gauge", f"{since_heartbeat:.3f}")
+    if stream is not None:
+        metric("twitter_stream_connected", "gauge", int(stream.connected))
+        metric("twitter_stream_reconnects_total", "counter", stream.reconnects)
+    _histogram(lines, "twitter_stream_parse_seconds", metrics.parse)
+    _histogram(lines, "twitter_stream_dispatch_seconds", metrics.dispatch)
+    
+    per_handle = (("bytes_written", "twitter_handle_bytes_written_total", "counter"),
+                  ("flush_count", "twitter_handle_flushes_total", "counter"),
+                  ("flush_seconds", "twitter_handle_flush_seconds_total", "counter"),
+                  ("max_flush_seconds", "twitter_handle_flush_seconds_max", "gauge"),
+                  ("queue_depth", "twitter_handle_queue_depth", "gauge"),
+                  ("dropped_bytes", "twitter_handle_dropped_total", "counter"),
+                  ("spilled_bytes", "twitter_handle_spilled_bytes_total", "counter"))
+    writers = [(handle.name, handle.writer) for handle in handles if handle.writer is not None]
+    for attr, name, kind in per_handle:
+        lines.append(f"# TYPE {name} {kind}")
+        for handle_name, writer in writers:
+            lines.append(f'{name}{{handle="{_escape(handle_name)}"}} {getattr(writer.stats, attr, 0)}')
+    lines.append("# TYPE twitter_handle_pending gauge")
+    for handle_name, writer in writers:
+        lines.append(f'twitter_handle_pending{{handle="{_escape(handle_name)}"}} {writer.pending}')
+        
+    return "\n".join(lines) + "\n"
+
+async def serve(render, host='127.0.0.1', port=9100):
+    '''starts a minimal HTTP server answering GET /metrics with render()'''
+    
+    async def respond(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip(): # skip headers
+                pass
+            
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] in (b'/metrics', b'/'):
+                status, body = "200 OK", render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        finally:
+            writer.close()
+            
+    return await asyncio.start_server(respond, host, port)
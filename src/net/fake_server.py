@@ -0,0 +1,219 @@
+'''
+A local stand-in for the parts of the Twitter API used by TwitterSession, for
+benchmarks and for testing reconnects without a bearer token.
+
+Serves /2/tweets/search/stream/rules and /2/tweets/search/stream. The stream replays a
+recorded JSONL file (full responses, or bare tweets that get matching rules assigned)
+or generates tweets, at a fixed rate or as fast as possible, and can inject keep-alives,
+disconnects and 429s. The rules endpoint answers with x-rate-limit-* headers and 429s
+past its limit, like the real one.
+
+    python -m net.fake_server --port 8080 --replay tweets.jsonl --rate 500
+
+@author: diego
+'''
+from aiohttp import web
+from itertools import count, cycle
+from orjson import orjson
+import argparse
+import asyncio
+import random
+import time
+
+WORDS = ("rust", "python", "stream", "tweet", "rules", "async", "coffee", "deploy", "weekend", "music",
+         "football", "election", "weather", "launch", "breaking", "review", "update", "release")
+
+def synthetic_tweets(seed=0):
+    '''endless bare tweets with increasing ids'''
+    rng = random.Random(seed)
+    for id in count(1500000000000000000):
+        yield {"id": str(id), "author_id": str(rng.randrange(1, 10**9)),
+               "text": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(6, 30)))}
+
+def replayed_tweets(path):
+    '''endless loop over a recorded JSONL file'''
+    with open(path, 'rb') as file:
+        lines = [line for line in file if line.strip()]
+    if not lines:
+        raise ValueError(f"{path} has no tweets")
+    for line in cycle(lines):
+        yield orjson.loads(line)
+
+class FakeTwitter():
+    '''State of the fake API: the rules and how the stream misbehaves'''
+    
+    def __init__(self, tweets, rate=0.0, keep_alive=20.0, disconnect_every=0, rate_limit_every=0, 
+                 rules_per_tweet=2, token=None, seed=0, rules_limit=450, rules_window=900):
+        self.tweets = tweets # iterator of responses or bare tweets
+        self.rate = rate # tweets per second, 0 is as fast as possible
+        self.keep_alive = keep_alive # seconds between keep-alives
+        self.disconnect_every = disconnect_every # tweets sent before closing a connection, 0 never
+        self.rate_limit_every = rate_limit_every # every n-th connection gets a 429, 0 never
+        self.rules_per_tweet = rules_per_tweet
+        self.token = token # bearer token to require, None accepts any
+        self.rules_limit = rules_limit # requests per window and method on the rules endpoint, 0 unlimited
+        self.rules_window = rules_window # seconds
+        self._windows: dict[str, list] = dict() # method -> [window end, requests]
+        self.rules: dict[str, dict] = dict()
+        self.connections = 0
+        self.sent = 0
+        self._ids = count(1600000000000000000)
+        self._rng = random.Random(seed)
+        
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/2/tweets/search/stream/rules', self.get_rules)
+        app.router.add_post('/2/tweets/search/stream/rules', self.post_rules)
+        app.router.add_get('/2/tweets/search/stream', self.stream)
+        return app
+    
+    def _authorized(self, request):
+        return self.token is None or request.headers.get('Authorization') == f"Bearer {self.token}"
+    
+    def _unauthorized(self):
+        return web.json_response({"title": "Unauthorized", "type": "about:blank", "status": 401,
+                                  "detail": "Unauthorized"}, status=401)
+        
+    def _limited(self, request):
+        '''the rate limit headers of a rules request, and whether it's over the limit'''
+        if not self.rules_limit:
+            return {}, False
+        now = time.time()
+        window = self._windows.get(request.method)
+        if window is None or now >= window[0]:
+            window = self._windows[request.method] = [int(now) + self.rules_window, 0]
+        window[1] += 1
+        headers = {'x-rate-limit-limit': str(self.rules_limit), 'x-rate-limit-reset': str(window[0]),
+                   'x-rate-limit-remaining': str(max(0, self.rules_limit - window[1]))}
+        return headers, window[1] > self.rules_limit
+    
+    def _too_many(self, headers):
+        return web.json_response({"title": "Too Many Requests", "status": 429}, status=429, headers=headers)
+        
+    def _meta(self, **extra):
+        return dict(sent=time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()), **extra)
+    
+    async def get_rules(self, request):
+        if not self._authorized(request):
+            return self._unauthorized()
+        headers, limited = self._limited(request)
+        if limited:
+            return self._too_many(headers)
+        body = {"meta": self._meta(result_count=len(self.rules))}
+        if self.rules:
+            body["data"] = list(self.rules.values())
+        return web.Response(body=orjson.dumps(body), content_type='application/json', headers=headers)
+    
+    async def post_rules(self, request):
+        if not self._authorized(request):
+            return self._unauthorized()
+        headers, limited = self._limited(request)
+        if limited:
+            return self._too_many(headers)
+        payload = orjson.loads(await request.read())
+        dry_run = request.query.get('dry_run') == 'true'
+        
+        if 'delete' in payload:
+            ids = payload['delete']['ids']
+            deleted = [id for id in ids if id in self.rules]
+            if not dry_run:
+                for id in deleted:
+                    del self.rules[id]
+            body = {"meta": self._meta(summary={"deleted": len(deleted), "not_deleted": len(ids) - len(deleted)})}
+            return web.Response(body=orjson.dumps(body), content_type='application/json', headers=headers)
+        
+        created = list()
+        existing = {rule['value'] for rule in self.rules.values()}
+        errors = list()
+        for rule in payload.get('add', []):
+            if rule['value'] in existing:
+                errors.append({"value": rule['value'], "id": next(id for id, r in self.rules.items() 
+                                                                   if r['value'] == rule['value']),
+                               "title": "DuplicateRule", "type": "https://api.twitter.com/2/problems/duplicate-rules"})
+                continue
+            new = {"id": str(next(self._ids)), "value": rule['value']}
+            if rule.get('tag'):
+                new['tag'] = rule['tag']
+            created.append(new)
+            existing.add(rule['value'])
+        if not dry_run:
+            for rule in created:
+                self.rules[rule['id']] = rule
+                
+        body = {"meta": self._meta(summary={"created": len(created), "not_created": len(errors),
+                                            "valid": len(created), "invalid": 0})}
+        if created:
+            body['data'] = created
+        if errors:
+            body['errors'] = errors
+        return web.Response(body=orjson.dumps(body), content_type='application/json', status=201, headers=headers)
+    
+    def _response(self, tweet) -> bytes:
+        '''a stream line, bare tweets get some of the current rules as matching rules'''
+        if 'data' not in tweet:
+            rules = list(self.rules.values())
+            if rules:
+                picked = self._rng.sample(rules, min(len(rules), self._rng.randint(1, self.rules_per_tweet)))
+            else:
+                picked = []
+            tweet = {"data": tweet, "matching_rules": [{"id": r['id'], "tag": r.get('tag', '')} for r in picked]}
+        return orjson.dumps(tweet) + b"\r\n"
+    
+    async def stream(self, request):
+        if not self._authorized(request):
+            return self._unauthorized()
+        self.connections += 1
+        if self.rate_limit_every and self.connections % self.rate_limit_every == 0:
+            return web.json_response({"title": "Too Many Requests", "status": 429}, status=429,
+                                     headers={'x-rate-limit-reset': str(int(time.time()) + 1)})
+        
+        resp = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await resp.prepare(request)
+        
+        start = time.monotonic()
+        last_keep_alive = start
+        sent_here = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if now - last_keep_alive >= self.keep_alive:
+                    await resp.write(b"\r\n")
+                    last_keep_alive = now
+                
+                # everything that is due by now, in one write
+                due = 1000 if not self.rate else int((now - start) * self.rate) - sent_here
+                if self.disconnect_every:
+                    due = min(due, self.disconnect_every - sent_here)
+                if due > 0:
+                    await resp.write(b"".join(self._response(next(self.tweets)) for _ in range(due)))
+                    sent_here += due
+                    self.sent += due
+                    
+                if self.disconnect_every and sent_here >= self.disconnect_every:
+                    break
+                await asyncio.sleep(0 if not self.rate else min(0.01, self.keep_alive))
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return resp
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Twitter filtered stream API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--replay', help="JSONL file of recorded responses or tweets, generated if omitted")
+    parser.add_argument('--rate', type=float, default=0.0, help="tweets per second, 0 for as fast as possible")
+    parser.add_argument('--keep-alive', type=float, default=20.0, help="seconds between keep-alives")
+    parser.add_argument('--disconnect-every', type=int, default=0, help="tweets per connection before dropping it")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every n-th connection with a 429")
+    parser.add_argument('--token', help="bearer token to require")
+    parser.add_argument('--rules-limit', type=int, default=450, help="rules requests per method and window, 0 unlimited")
+    parser.add_argument('--rules-window', type=float, default=900, help="seconds of a rules rate limit window")
+    args = parser.parse_args()
+    
+    tweets = replayed_tweets(args.replay) if args.replay else synthetic_tweets()
+    fake = FakeTwitter(tweets, args.rate, args.keep_alive, args.disconnect_every, args.rate_limit_every, token=args.token,
+                       rules_limit=args.rules_limit, rules_window=args.rules_window)
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
+    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+'''
+Packs many logical rules into few server rules: rules are OR-merged into server rules of at
+most max_length characters, and the tweets those server rules deliver are matched locally
+against the logical rules they contain, so handles keep receiving by logical rule
+
+@author: diego
+'''
+from filters import TOKEN
+from net.utils import Rule
+import re
+
+MAX_RULE_LENGTH = 512 # 1024 for academic access
+PACKED_TAG = "packed"
+
+### LOCAL EVALUATION
+def _tokenize(value: str):
+    '''splits a rule into '(', ')', 'OR', '-', ('phrase', text) and ('term', text)'''
+    tokens = list()
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isspace():
+            i += 1
+        elif char in '()':
+            tokens.append(char)
+            i += 1
+        elif char == '-' and i + 1 < len(value) and not value[i + 1].isspace():
+            tokens.append('-')
+            i += 1
+        elif char == '"':
+            end = i + 1
+            while end < len(value) and value[end] != '"':
+                end += 2 if value[end] == '\\' else 1
+            tokens.append(('phrase', value[i + 1:end].replace('\\"', '"')))
+            i = end + 1
+        else:
+            end = i
+            while end < len(value) and not value[end].isspace() and value[end] not in '()"':
+                end += 1
+            word = value[i:end]
+            tokens.append('OR' if word == 'OR' else ('term', word))
+            i = end
+    return tokens
+
+def parse(value: str):
+    '''parses a rule into nested tuples: ('or', parts), ('and', parts), ('not', node),
+    ('phrase', text), ('term', text) and ('op', name, argument). AND binds tighter than OR'''
+    tokens = _tokenize(value)
+    position = 0
+    
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+    
+    def expression():
+        nonlocal position
+        parts = [conjunction()]
+        while peek() == 'OR':
+            position += 1
+            parts.append(conjunction())
+        return parts[0] if len(parts) == 1 else ('or', tuple(parts))
+    
+    def conjunction():
+        parts = list()
+        while peek() not in (None, 'OR', ')'):
+            parts.append(unary())
+        if not parts:
+            raise ValueError(f"empty clause in rule '{value}'")
+        return parts[0] if len(parts) == 1 else ('and', tuple(parts))
+    
+    def unary():
+        nonlocal position
+        token = peek()
+        position += 1
+        if token == '-':
+            return ('not', unary())
+        if token == '(':
+            node = expression()
+            if peek() != ')':
+                raise ValueError(f"unbalanced parentheses in rule '{value}'")
+            position += 1
+            return node
+        kind, text = token
+        if kind == 'term' and ':' in text[1:]:
+            name, _, argument = text.partition(':')
+            return ('op', name.lower(), argument)
+        return (kind, text.lower())
+    
+    node = expression()
+    if position != len(tokens):
+        raise ValueError(f"unexpected ')' in rule '{value}'")
+    return node
+
+class Context():
+    '''A tweet being matched, with its lowercase text and tokens computed once for every rule'''
+    __slots__ = ('response', 'data', '_text', '_tokens')
+    
+    def __init__(self, response):
+        self.response = response
+        self.data = response['data']
+        self._text = None
+        self._tokens = None
+        
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.data.get('text', '').lower()
+        return self._text
+    
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            tokens = set(TOKEN.findall(self.text))
+            tokens.update([token[1:] for token in tokens if token[0] in '#@$'])
+            self._tokens = tokens
+        return self._tokens
+    
+    def author_username(self):
+        author = self.data.get('author_id')
+        for user in self.response.get('includes', {}).get('users', ()):
+            if user.get('id') == author:
+                return user.get('username', '').lower()
+        return None
+
+def _contains(context, text):
+    if TOKEN.fullmatch(text):
+        return text in context.tokens
+    return re.search(rf"(?<!\w){re.escape(text)}(?!\w)", context.text) is not None
+
+def _operator(name, argument, context):
+    '''True/False, or None when the tweet doesn't carry what's needed to decide'''
+    data = context.data
+    argument_lower = argument.lower()
+    match name:
+        case 'from':
+            if argument.isdigit():
+                return data.get('author_id') == argument
+            username = context.author_username()
+            return None if username is None else username == argument_lower.lstrip('@')
+        case 'lang':
+            return None if 'lang' not in data else data['lang'] == argument_lower
+        case 'is':
+            references = data.get('referenced_tweets')
+            kinds = {reference.get('type') for reference in references} if references else set()
+            match argument_lower:
+                case 'retweet':
+                    return 'retweeted' in kinds or context.text.startswith('rt @')
+                case 'quote':
+                    return 'quoted' in kinds if references is not None else None
+                case 'reply':
+                    return 'replied_to' in kinds or 'in_reply_to_user_id' in data if references is not None else None
+        case 'has':
+            match argument_lower:
+                case 'links':
+                    return 'https://t.co/' in context.text
+                case 'mentions':
+                    return any(token[0] == '@' for token in context.tokens)
+                case 'hashtags':
+                    return any(token[0] == '#' for token in context.tokens)
+    return None
+
+def evaluate(node, context):
+    '''three valued: True, False or None for unknown'''
+    kind = node[0]
+    match kind:
+        case 'term':
+            return _contains(context, node[1])
+        case 'phrase':
+            return re.search(rf"(?<!\w){re.escape(node[1])}(?!\w)", context.text) is not None
+        case 'op':
+            return _operator(node[1], node[2], context)
+        case 'not':
+            value = evaluate(node[1], context)
+            return None if value is None else not value
+        case 'and':
+            result = True
+            for part in node[1]:
+                value = evaluate(part, context)
+                if value is False:
+                    return False
+                if value is None:
+                    result = None
+            return result
+        case 'or':
+            result = False
+            for part in node[1]:
+                value = evaluate(part, context)
+                if value is True:
+                    return True
+                if value is None:
+                    result = None
+            return result
+
+def needs(node) -> dict:
+    '''stream params the local evaluation of a rule reads'''
+    found = dict()
+    def walk(node):
+        match node:
+            case ('op', 'lang', _):
+                found.setdefault('tweet.fields', set()).add('lang')
+            case ('op', 'from', argument) if not argument.isdigit():
+                found.setdefault('expansions', set()).add('author_id')
+            case ('op', 'is', _):
+                found.setdefault('tweet.fields', set()).update(('referenced_tweets', 'in_reply_to_user_id'))
+            case ('not', child):
+                walk(child)
+            case ('and' | 'or', parts):
+                for part in parts:
+                    walk(part)
+    walk(node)
+    return found
+
+class LogicalRule():
+    '''A rule packed into a server rule, matched locally. Unknown results count as a match
+    so a tweet is never lost, at worst a handle gets a tweet its rule wouldn't have matched'''
+    __slots__ = ('id', 'tag', 'tree')
+    
+    def __init__(self, id, tag, value):
+        self.id = id
+        self.tag = tag
+        self.tree = parse(value)
+        
+    def matches(self, context) -> bool:
+        return evaluate(self.tree, context) is not False
+    
+    def __getstate__(self):
+        return (self.id, self.tag, self.tree)
+    
+    def __setstate__(self, state):
+        self.id, self.tag, self.tree = state
+
+def demux(matching: list, response: dict, packed: dict) -> list:
+    '''replaces the packed server rules in matching_rules by the logical rules the tweet matches.
+    The server saw more than the text read here (the full text of retweets and long tweets, expanded
+    urls), so when none of the members matches the tweet goes to all of them rather than to none'''
+    out = list()
+    context = None
+    for rule in matching:
+        members = packed.get(rule['id'])
+        if members is None:
+            out.append(rule)
+            continue
+        if context is None:
+            context = Context(response)
+        matched = [member for member in members if member.matches(context)] or members
+        out.extend({'id': member.id, 'tag': member.tag} for member in matched)
+    return out
+
+### PACKING
+def _clause(value: str):
+    value = value.strip()
+    return value if not any(char.isspace() for char in value) else f"({value})"
+
+def pack(rules: list, max_length=MAX_RULE_LENGTH) -> list:
+    '''first fit decreasing: returns [(server rule value, [logical rules])] with every value at most
+    max_length long. Rules with the same value share one clause, rules too long stay alone'''
+    by_value: dict[str, list] = dict()
+    for rule in rules:
+        by_value.setdefault(_clause(rule.rules), []).append(rule)
+    if not by_value:
+        return []
+    
+    clauses = sorted(by_value, key=len, reverse=True)
+    shortest = len(clauses[-1])
+    bins: list[list] = list() # [length, clauses, rules]
+    open_bins: list[list] = list() # bins that can still take the shortest clause
+    for clause in clauses:
+        size = len(clause)
+        for box in open_bins:
+            if box[0] + 4 + size <= max_length: # ' OR '
+                box[0] += 4 + size
+                box[1].append(clause)
+                box[2].extend(by_value[clause])
+                if box[0] + 4 + shortest > max_length:
+                    open_bins.remove(box)
+                break
+        else:
+            box = [size, [clause], list(by_value[clause])]
+            bins.append(box)
+            if size + 4 + shortest <= max_length:
+                open_bins.append(box)
+    
+    packed = list()
+    for _, box_clauses, members in bins:
+        value = " OR ".join(box_clauses) if len(box_clauses) > 1 else members[0].rules.strip()
+        packed.append((value, members))
+    return packed
+
+def plan(rules: list, max_length=MAX_RULE_LENGTH):
+    '''the server Rules to create and, for each, the logical rules they contain'''
+    packed = list()
+    for n, (value, members) in enumerate(pack(rules, max_length)):
+        server = Rule(value, tag=f"{PACKED_TAG}:{n}", name=f"packed{n}")
+        packed.append((server, members))
+    return packed
@@ -0,0 +1,54 @@
+'''
+Client side of the REST rate limits. Each endpoint is a token bucket refilled from the
+x-rate-limit-limit/remaining/reset headers of its responses, so concurrent requests wait
+for the window to reset instead of being answered with a 429
+
+@author: diego
+'''
+import asyncio
+import time
+
+class RateLimit():
+    '''Token bucket of one endpoint. Until a response tells the limits, requests aren't held'''
+
+    def __init__(self):
+        self.limit: int = None # requests per window
+        self.remaining: int = None # left in this window, counting the requests in flight
+        self.reset: float = None # epoch seconds the window ends
+        self.window: float = None # seconds a window lasts, estimated from the resets the server sent
+
+    async def acquire(self):
+        '''waits until a request can be sent and takes its token'''
+        while True:
+            now = time.time()
+            if self.reset is not None and now >= self.reset:
+                # the next window's end is estimated until a response tells it, so waiters always have one
+                self.remaining, self.reset = self.limit, now + (self.window or 1.0)
+            if self.remaining is None or self.remaining > 0:
+                if self.remaining is not None:
+                    self.remaining -= 1
+                return
+            await asyncio.sleep(self.reset - now + 0.1)
+
+    def update(self, headers):
+        '''reads the limits of a response, the server's count only lowers the local one
+        within a window since the local one counts the requests still in flight'''
+        try:
+            limit = int(headers['x-rate-limit-limit'])
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = float(headers['x-rate-limit-reset'])
+        except (KeyError, ValueError):
+            return
+        if reset == self.reset and self.remaining is not None:
+            remaining = min(remaining, self.remaining)
+        elif reset > time.time():
+            self.window = max(self.window or 0.0, reset - time.time())
+        self.limit, self.remaining, self.reset = limit, remaining, reset
+
+    def exhausted(self, reset=None):
+        '''after a 429, holds the requests until the window resets'''
+        self.remaining = 0
+        if reset is not None:
+            self.reset = float(reset)
+        elif self.reset is None:
+            self.reset = time.time() + 60
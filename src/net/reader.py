@@ -0,0 +1,43 @@
+'''
+Splits the byte chunks of a response into lines, so a whole chunk of tweets is handed over
+at once instead of awaiting every line
+
+@author: diego
+'''
+
+class LineSplitter():
+    '''Turns chunks into complete lines. A line cut by the end of a chunk is kept in a reusable
+    bytearray until the chunk that completes it arrives. Lines are returned without the b"\\n",
+    twitter's b"\\r" stays and is removed by strip() like any whitespace'''
+    
+    def __init__(self):
+        self._partial = bytearray()
+        
+    def feed(self, chunk: bytes) -> list:
+        '''returns the lines completed by the chunk'''
+        lines = chunk.split(b"\n") # in C, one pass over the chunk
+        tail = lines.pop()
+        
+        if not lines: # no newline in the chunk
+            self._partial += tail
+            return lines
+        
+        if self._partial:
+            self._partial += lines[0]
+            lines[0] = bytes(self._partial)
+            self._partial.clear()
+        self._partial += tail
+        return lines
+    
+    @property
+    def pending(self):
+        '''bytes of the incomplete line'''
+        return len(self._partial)
+
+async def read_batches(content):
+    '''yields the list of lines completed by every chunk read from an aiohttp StreamReader'''
+    splitter = LineSplitter()
+    async for chunk in content.iter_any():
+        lines = splitter.feed(chunk)
+        if lines:
+            yield lines
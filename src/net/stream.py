@@ -0,0 +1,136 @@
+'''
+Supervises the connection to the filtered stream. Disconnects and stalls (no data or
+keep-alive within stall_timeout) are followed by a reconnect with exponential backoff
+and jitter, and tweets delivered twice across a reconnect are filtered out by id
+
+@author: diego
+'''
+from aiohttp import ClientError
+from collections import deque
+from net.reader import read_batches
+import asyncio
+import random
+import time
+
+# (first delay, max delay) in seconds of each kind of failure
+NETWORK_BACKOFF = (0.25, 16.0)
+HTTP_BACKOFF = (5.0, 320.0)
+RATE_LIMIT_BACKOFF = (60.0, 960.0)
+
+class RecentIds():
+    '''Bounded set of the last tweet ids seen, the oldest are forgotten first'''
+    
+    def __init__(self, size=10000):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+        
+    def seen(self, id) -> bool:
+        '''True if the id was already seen, otherwise remembers it'''
+        if id in self._ids:
+            return True
+        self._ids.add(id)
+        self._order.append(id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return False
+    
+class StreamSupervisor():
+    '''Iterates over the lines of the filtered stream across any number of connections'''
+    
+    def __init__(self, session, params: dict, stall_timeout=30.0, backfill_minutes=0, dedup_size=10000):
+        self.session = session
+        self.params = params
+        self.stall_timeout = stall_timeout # twitter sends a keep-alive every 20 seconds
+        self.backfill_minutes = backfill_minutes # asked for on reconnect, needs academic access
+        # only a backfill can deliver a tweet twice
+        self.recent = RecentIds(dedup_size) if backfill_minutes and dedup_size else None
+        self.delivered = None # only a ShardedStream has tweets delivered by several connections
+        self.reconnects = 0
+        self.connected = False
+        self._response = None
+        self._stopped = False
+        self._failures = 0
+        self._disconnected_at = None
+        
+    def _next_params(self):
+        '''params of the next connection, with backfill covering the time spent disconnected'''
+        if not self.backfill_minutes or self._disconnected_at is None:
+            return self.params
+        
+        minutes = int((time.monotonic() - self._disconnected_at) // 60) + 1
+        return dict(self.params, backfill_minutes=min(minutes, self.backfill_minutes))
+        
+    def _delay(self, backoff, reset=None):
+        '''exponential backoff with jitter, or the rate limit reset if it's later'''
+        first, cap = backoff
+        delay = min(cap, first * 2 ** self._failures)
+        delay = random.uniform(delay / 2, delay)
+        if reset is not None:
+            delay = max(delay, float(reset) - time.time())
+        self._failures += 1
+        return delay
+    
+    async def _connect(self):
+        '''returns an open response, waiting and retrying until one is accepted'''
+        from net.utils import Unauthorized
+        
+        while not self._stopped:
+            try:
+                resp = await self.session.open_stream(self._next_params(), self.stall_timeout)
+            except (ClientError, asyncio.TimeoutError, OSError) as e:
+                await self._wait(self._delay(NETWORK_BACKOFF), f"couldn't connect ({type(e).__name__})")
+                continue
+            
+            match resp.status:
+                case 200:
+                    self._failures = 0
+                    return resp
+                case 401 | 403:
+                    resp.release()
+                    raise Unauthorized(self.session.token)
+                case 429:
+                    reset = resp.headers.get('x-rate-limit-reset')
+                    resp.release()
+                    await self._wait(self._delay(RATE_LIMIT_BACKOFF, reset), "rate limited")
+                case _:
+                    status = resp.status
+                    resp.release()
+                    await self._wait(self._delay(HTTP_BACKOFF), f"HTTP {status}")
+        return None
+    
+    async def _wait(self, delay, reason):
+        print(f"\nStream {reason}, reconnecting in {delay:.1f}s")
+        await asyncio.sleep(delay)
+                
+    async def batches(self):
+        '''yields the lists of lines received, keep-alives included, until stop() is called'''
+        while not self._stopped:
+            self._response = await self._connect()
+            if self._response is None:
+                return
+            if self._disconnected_at is not None:
+                self.reconnects += 1
+            self.connected = True
+            
+            try:
+                async for lines in read_batches(self._response.content):
+                    yield lines
+                reason = "disconnected"
+            except asyncio.TimeoutError:
+                reason = f"stalled for {self.stall_timeout}s"
+            except (ClientError, OSError) as e:
+                reason = f"disconnected ({type(e).__name__})"
+            finally:
+                self.connected = False
+                self._disconnected_at = time.monotonic()
+                self._response.close()
+                
+            if not self._stopped:
+                await self._wait(self._delay(NETWORK_BACKOFF), reason)
+                
+    def stop(self):
+        '''ends lines(), closing the current connection'''
+        self._stopped = True
+        if self._response is not None:
+            self._response.close()
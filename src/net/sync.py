@@ -0,0 +1,74 @@
+'''
+Declarative synchronization of the rules: the local rules are compared with the server's by
+normalized value and only the difference is sent, in as few requests as the API's limits allow
+
+@author: diego
+'''
+from net.utils import Rule, normalize, chunks, MAX_ADD_PER_REQUEST, MAX_DELETE_PER_REQUEST
+import asyncio
+
+class RuleDiff():
+    '''What has to change for the server to have the local rules'''
+    __slots__ = ('add', 'delete', 'keep', 'pull', 'retag')
+
+    def __init__(self):
+        self.add: list[Rule] = list() # local rules the server doesn't have
+        self.delete: list[str] = list() # ids of server rules that aren't wanted
+        self.keep: list[tuple] = list() # (local rule, server id) already on the server
+        self.pull: list[Rule] = list() # server rules unknown locally, deleted when pushing
+        self.retag: set = set() # values deleted and added again only to change their tag
+
+    def __bool__(self):
+        return bool(self.add or self.delete)
+
+    def __str__(self):
+        return "{} to add, {} to delete, {} unchanged".format(len(self.add), len(self.delete), len(self.keep))
+
+def diff(local: list, server: list, pull=False) -> RuleDiff:
+    '''compares local Rules with the server's rules ('data' of get_rules). With pull, the server's
+    rules unknown locally are kept and returned in pull instead of being deleted'''
+    result = RuleDiff()
+    remote = {normalize(rule['value']): rule for rule in server}
+
+    for rule in local:
+        value = normalize(rule.rules)
+        found = remote.pop(value, None)
+        if found is None:
+            result.add.append(rule)
+        elif (found.get('tag') or None) != (rule.tag or None):
+            result.delete.append(found['id'])
+            result.add.append(rule)
+            result.retag.add(value)
+        else:
+            result.keep.append((rule, found['id']))
+
+    for value, found in remote.items():
+        if pull:
+            result.pull.append(Rule(rules=found['value'], tag=found.get('tag'), id=found['id']))
+        else:
+            result.delete.append(found['id'])
+    return result
+
+async def apply(session, changes: RuleDiff, validate=True) -> int:
+    '''Sends a diff, returning the number of requests. The additions are validated with a dry run
+    first so an invalid rule doesn't leave the server half synchronized. Deletions go first
+    since they make room under the rules cap. The chunks of each step are sent concurrently'''
+    steps = list() # the arguments of the modify_rules calls of each step
+    if validate:
+        checked = [rule for rule in changes.add if normalize(rule.rules) not in changes.retag]
+        steps.append([dict(add=chunk, dry_run=True) for chunk in chunks(checked, MAX_ADD_PER_REQUEST)])
+    steps.append([dict(delete=chunk) for chunk in chunks(changes.delete, MAX_DELETE_PER_REQUEST)])
+    steps.append([dict(add=chunk) for chunk in chunks(changes.add, MAX_ADD_PER_REQUEST)])
+
+    requests = 0
+    for step in steps:
+        await _gather([session.modify_rules(**arguments) for arguments in step])
+        requests += len(step)
+    return requests
+
+async def _gather(requests: list):
+    '''awaits all the requests, then raises the first error, so none is left running'''
+    results = await asyncio.gather(*requests, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
@@ -6,16 +6,23 @@ Created on Oct 17, 2022
 import sys
 from aiohttp.client_reqrep import ClientResponse
 from dataclasses import dataclass
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from collections import deque
-from orjson import dumps
+from orjson import dumps, loads
+from net.ratelimit import RateLimit
 from importlib import reload
 from itertools import count
 
 import asyncio
 import os
+import time
 
 rules_count = count() #Counter for rules' names
+API_URL = "https://api.twitter.com"
+RULES_PATH = '/2/tweets/search/stream/rules'
+MAX_CONCURRENT_REQUESTS = 4 # rule requests in flight at once
+MAX_ADD_PER_REQUEST = 100 # rules added by one POST
+MAX_DELETE_PER_REQUEST = 1000 # ids deleted by one POST
 
 @dataclass(repr = False, init=False)
 class Rule():
@@ -146,7 +153,18 @@ class Rule():
     
     def json(self):
         '''returns json respresentation'''
-        return {"value":self.rules, "tag":self.rules}
+        if self.tag:
+            return {"value":self.rules, "tag":self.tag}
+        return {"value":self.rules}
+
+def chunks(items: list, size: int):
+    '''splits a list for requests that take at most size items'''
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def normalize(value: str) -> str:
+    '''the value rules are compared by, the server keeps values as they were sent'''
+    return " ".join(value.split())
 
 def _check_add_rules(status: int, json):
     '''when adding rules, the response is sent here and will throw custom exceptions if an error occured'''
@@ -170,32 +188,65 @@ class TwitterSession():
     '''Encapsulates the networking with Twitter'''
     
     
-    async def __init__(self, token):
+    async def __init__(self, token, base_url=API_URL):
         self._d_header = {"content-type":'application/json', "Authorization" : f"Bearer {token}"}
-        session = ClientSession("https://api.twitter.com" , headers = self.default_headers)
+        # the rules calls and the stream get their own pools, so a rule edit never waits on the stream's socket
+        session = ClientSession(base_url, headers = self.default_headers, 
+                                connector=TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=300, keepalive_timeout=60))
         self.session: ClientSession = session
+        self.stream_session = ClientSession(base_url, headers = self.default_headers,
+                                            connector=TCPConnector(limit=1, ttl_dns_cache=300, enable_cleanup_closed=True))
         self.token=token
+        self.base_url = base_url
+        self.initial_rules: dict = None # get_rules response read when validating the token
+        self.limits = {'GET': RateLimit(), 'POST': RateLimit()} # of the rules endpoint, by method
         await self.validate_token()
         
     async def __new__(cls, *args, **kwargs):
         '''Custom instanstiation to handle an asynchornous init function'''
         instance = super(TwitterSession, cls).__new__(cls)
-        await instance.__init__(*args, **kwargs)
+        try:
+            await instance.__init__(*args, **kwargs)
+        except BaseException: # a refused token or a failed first request, the pools are closed
+            await instance.close()
+            raise
         return instance
     
     @property
     def default_headers(self):
         return self._d_header
     
+    async def _request(self, method, path=RULES_PATH, **kwargs):
+        '''sends a rules request once its rate limit allows, retrying after a 429,
+        returns the status and the decoded body. Throws Unauthorized for a refused token,
+        RateLimited when the retries ran out and RequestFailed for any other error'''
+        limit = self.limits[method]
+        for attempt in range(3):
+            await limit.acquire()
+            async with self.session.request(method, path, **kwargs) as resp:
+                limit.update(resp.headers)
+                status = resp.status
+                body = loads(await resp.read())
+            if status != 429:
+                break
+            limit.exhausted(resp.headers.get('x-rate-limit-reset'))
+        match status:
+            case 429:
+                raise RateLimited(status, body, limit.reset)
+            case 401 | 403:
+                raise Unauthorized(self.token)
+        if not 200 <= status < 300:
+            raise RequestFailed(status, body)
+        return status, body
+    
     async def validate_token(self):
         '''Throws Unauthorized exception if bearer token is not accepted by Twitter'''
-        resp = await self.session.get('/2/tweets/search/stream/rules')
-        
-        if resp.status == 401 and (await resp.json())["title"]=='Unauthorized':
-            raise Unauthorized(self.token)
+        _, body = await self._request('GET')
+        self.initial_rules = body
     
-    async def modify_rules(self,*, add = None, delete=None):
-        '''Allows one to add or delete rules in the Twitter Server'''
+    async def modify_rules(self,*, add = None, delete=None, dry_run=False):
+        '''Allows one to add or delete rules in the Twitter Server, 
+        with dry_run the server only validates them'''
         payload = dict()
         
         if add is not None: # add 'add' value to payload along with rules to be added
@@ -207,23 +258,24 @@ class TwitterSession():
         if delete is not None: # add delete value in payload json with ids to be deleted
             payload['delete'] = {"ids": (delete)}        
             
-        resp =  await self.session.post('/2/tweets/search/stream/rules', data=dumps(payload))
+        status, resp = await self._request('POST', data=dumps(payload), params={'dry_run': 'true'} if dry_run else None)
         
-        _check_add_rules(resp.status, await resp.json())
+        # used to backfill the id of the rules sent to add, before checking for errors so the
+        # rules that were created when others weren't can be told apart and removed
+        if add is not None and not dry_run:
+            sent = {normalize(rule.rules): rule for rule in add}
+            for rule_json in resp.get('data', ()):
+                rule = sent.get(normalize(rule_json['value']))
+                if rule is not None:
+                    rule.id = rule_json['id']
         
-        resp = await resp.json()
-        
-        if add is not None: # used to backfill the id of the rules sent to add
-            for rule_json in resp['data']:
-                for rule in add:
-                    if rule.rules == rule_json['value']:
-                        rule.id = rule_json['id']
+        _check_add_rules(status, resp)
         return resp
         
     async def get_rules(self ):
         '''Fetch rules from the server'''
-        resp = await self.session.get('/2/tweets/search/stream/rules')
-        return (await resp.json())
+        _, body = await self._request('GET')
+        return body
         
     async def remove_all_rules(self):
         '''helper function to delete all rules'''
@@ -235,28 +287,27 @@ class TwitterSession():
         for rule in resp['data']:
             ls.append(rule['id'])
         
-        return(await self.modify_rules(delete = ls))    
+        await asyncio.gather(*[self.modify_rules(delete = chunk) for chunk in chunks(ls, MAX_DELETE_PER_REQUEST)])
         
     async def close(self):
-        '''closes ClientSession'''
+        '''closes the ClientSessions'''
         if not self.session.closed:
             await self.session.close()
+        if not self.stream_session.closed:
+            await self.stream_session.close()
             
-    async def stream(self, timeout):
-        '''return filtered stream with specified timeout'''
-        params = {"tweet.fields" :"author_id,text","media.fields":"url"}
-        
-        if hasattr(self, '_stream'): # Caches stream, because stream would delay closing.
-            resp = getattr(self, '_stream')
-            
-            if resp.closed:
-                delattr(self, '_stream')
-                return self.stream(timeout)
-        else:
-            resp: ClientResponse = await self.session.get('/2/tweets/search/stream', params = params, timeout=timeout)
+    async def open_stream(self, params, stall_timeout) -> ClientResponse:
+        '''opens one connection to the filtered stream, failing if nothing is read for stall_timeout seconds'''
+        return await self.stream_session.get('/2/tweets/search/stream', params = params, 
+                                      timeout=ClientTimeout(total=None, sock_connect=10, sock_read=stall_timeout))
             
-            setattr(self, '_stream', resp)
-            return resp
+    def stream(self, params=None, **kwargs):
+        '''return a supervised filtered stream, which reconnects until stopped'''
+        from net.stream import StreamSupervisor
+        
+        if params is None:
+            params = {"tweet.fields" :"author_id,text"}
+        return StreamSupervisor(self, params, **kwargs)
        
     @property
     def closed(self):
@@ -279,4 +330,22 @@ class InvalidRule(BaseException):
     pass
 class DuplicateRule(InvalidRule):
     '''Rule duplicate exists'''
-    pass
\ No newline at end of file
+    pass
+
+class RequestFailed(Exception):
+    '''A rules request was answered with an error, unlike the ones above a command failing on it is reported like any other'''
+    
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        detail = body.get('detail') or body.get('title') if isinstance(body, dict) else None
+        Exception.__init__(self, f"HTTP {status}{f': {detail}' if detail else ''}")
+
+class RateLimited(RequestFailed):
+    '''The rules endpoint was still rate limited after the retries'''
+    
+    def __init__(self, status, body, reset=None):
+        RequestFailed.__init__(self, status, body)
+        self.reset = reset # epoch seconds the window ends
+        if reset is not None:
+            self.args = (f"rate limited for {max(0, reset - time.time()):.0f}s more",)
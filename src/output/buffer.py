@@ -0,0 +1,90 @@
+'''
+Buffers the lines written to a handle and flushes them to disk, or a sink, in large chunks
+
+@author: diego
+'''
+from output.files import OutputFile
+from dataclasses import dataclass
+import time
+
+@dataclass
+class WriterStats:
+    '''Counters kept by a writer, used for tuning the flush settings'''
+    bytes_buffered: int = 0 # total bytes passed to write()
+    bytes_written: int = 0 # total bytes that reached the file
+    flush_count: int = 0
+    flush_seconds: float = 0.0 # total time spent in flushes
+    max_flush_seconds: float = 0.0
+    
+    @property
+    def avg_flush_seconds(self):
+        return self.flush_seconds / self.flush_count if self.flush_count else 0.0
+    
+    def record_flush(self, size, seconds):
+        '''adds a finished flush to the counters'''
+        self.bytes_written += size
+        self.flush_count += 1
+        self.flush_seconds += seconds
+        if seconds > self.max_flush_seconds:
+            self.max_flush_seconds = seconds
+    
+    def __str__(self):
+        return (f"buffered {self.bytes_buffered}B, written {self.bytes_written}B, "
+                f"{self.flush_count} flushes, avg {self.avg_flush_seconds*1000:.2f}ms, "
+                f"max {self.max_flush_seconds*1000:.2f}ms")
+
+class BufferedWriter():
+    '''Accumulates lines in a bytearray and writes them out once flush_size bytes
+    are held or flush_interval seconds have passed since the last flush'''
+    
+    def __init__(self, output: OutputFile, flush_size=1 << 16, flush_interval=1.0):
+        self.output = output
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.stats = WriterStats()
+        self._buffer = bytearray()
+        self._last_flush = time.monotonic()
+        
+    def open(self):
+        '''opens the output, which is unbuffered so the bytearray is the only buffer'''
+        self.output.open()
+        self._last_flush = time.monotonic()
+    
+    @property
+    def pending(self):
+        '''bytes waiting for the next flush'''
+        return len(self._buffer)
+        
+    def write(self, line: bytes):
+        '''buffer a line, flushing if one of the triggers is reached'''
+        self._buffer += line
+        self.stats.bytes_buffered += len(line)
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+        else:
+            self.tick()
+            
+    def tick(self):
+        '''time trigger, flushes when the interval passed and something is buffered'''
+        if self._buffer and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        elif self.output.backlog: # a sink still holding lines the other process didn't take
+            self.output.drain()
+    
+    def flush(self):
+        '''write everything buffered to the file'''
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        
+        start = time.perf_counter()
+        size = self.output.write(self._buffer)
+        self.stats.record_flush(size, time.perf_counter() - start)
+        self._buffer.clear()
+        
+    def close(self):
+        '''flushes what's left and closes the file'''
+        if self.output.closed:
+            return
+        self.flush()
+        self.output.close()
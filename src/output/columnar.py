@@ -0,0 +1,135 @@
+'''
+Columnar output for handles: tweets are collected into columns and written as record
+batches to a Parquet or Arrow IPC file, one row group per batch, so downstream jobs
+can load them without parsing JSON
+
+@author: diego
+'''
+from output.files import segment_path
+from output.pool import ThreadedWriter, WriterPool, BLOCK, SPILL
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError: # optional, only needed for columnar output
+    pyarrow = None
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+COLUMNS = ('id', 'author_id', 'text', 'rule_ids', 'rule_tags', 'received_at')
+
+def check_columnar():
+    '''throws ValueError if columnar output can't be written'''
+    if pyarrow is None:
+        raise ValueError("parquet and arrow output need the 'pyarrow' package installed")
+
+def schema():
+    check_columnar()
+    return pyarrow.schema([
+        ('id', pyarrow.string()),
+        ('author_id', pyarrow.string()),
+        ('text', pyarrow.string()),
+        ('rule_ids', pyarrow.list_(pyarrow.string())),
+        ('rule_tags', pyarrow.list_(pyarrow.string())),
+        ('received_at', pyarrow.timestamp('ms', tz='UTC')),
+    ])
+
+class ColumnarOutput():
+    '''File side of a ColumnarWriter, turns columns into a record batch and appends it'''
+    
+    def __init__(self, path, format='parquet'):
+        if format not in COLUMNAR_FORMATS:
+            raise ValueError(f"columnar format must be one of {', '.join(COLUMNAR_FORMATS)}")
+        check_columnar()
+        self.path = path
+        self.format = format
+        self._schema = schema()
+        self.current = None # file being written, a new segment when path was already there
+        self._sink = None
+        self._writer = None
+        
+    @property
+    def closed(self):
+        return self._sink is None
+    
+    def open(self):
+        '''starts a file, a columnar file can't be appended to so an existing one is kept
+        and the rows go to a segment named after the time it was started'''
+        self.current = segment_path(self.path, time.time()) if os.path.exists(self.path) else self.path
+        self._sink = pyarrow.OSFile(self.current, 'wb')
+        if self.format == 'parquet':
+            self._writer = pyarrow.parquet.ParquetWriter(self._sink, self._schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(self._sink, self._schema)
+            
+    def write(self, columns) -> int:
+        '''writes the columns as one row group, returns the bytes the file grew by'''
+        before = self._sink.tell()
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(columns, self._schema)]
+        self._writer.write_batch(pyarrow.record_batch(arrays, schema=self._schema))
+        return self._sink.tell() - before
+    
+    def close(self):
+        if self._sink is None:
+            return
+        self._writer.close()
+        self._sink.close()
+        self._sink = None
+        self._writer = None
+
+class ColumnarWriter(ThreadedWriter):
+    '''Collects tweets into columns on the loop and queues every full batch of row_group_size
+    rows to the writer pool, where it's converted and written. A batch is also queued when it
+    is older than flush_interval. Dropped batches are counted in rows, not bytes'''
+    
+    def __init__(self, output: ColumnarOutput, pool: WriterPool, row_group_size=10000, flush_interval=60.0,
+                 backpressure=BLOCK, max_batches=64):
+        if backpressure == SPILL:
+            raise ValueError("columnar handles can't spill, use block or drop")
+        ThreadedWriter.__init__(self, output, pool, row_group_size, flush_interval, backpressure, max_batches)
+        self._columns = self._empty()
+        
+    @staticmethod
+    def _empty():
+        return tuple(list() for _ in COLUMNS)
+    
+    @property
+    def pending(self):
+        '''rows waiting for the next batch'''
+        return len(self._columns[0])
+    
+    def _size(self, batch):
+        return len(batch[0])
+    
+    def write(self, line: bytes):
+        raise TypeError("columnar writers take tweets through append()")
+        
+    def append(self, tweet: dict, matching_rules: list, received: float, size: int):
+        '''adds the 'data' object of a response, its matching rules and the time it was read'''
+        ids, authors, texts, rule_ids, rule_tags, received_at = self._columns
+        ids.append(tweet.get('id'))
+        authors.append(tweet.get('author_id'))
+        texts.append(tweet.get('text'))
+        rule_ids.append([rule['id'] for rule in matching_rules])
+        rule_tags.append([rule.get('tag') for rule in matching_rules])
+        received_at.append(int(received * 1000))
+        self.stats.bytes_buffered += size
+        
+        if len(ids) >= self.flush_size:
+            self.flush()
+        else:
+            self.tick()
+            
+    def tick(self):
+        if self._columns[0] and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+            
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._columns[0]:
+            return
+        batch = self._columns
+        self._columns = self._empty()
+        self._submit(batch)
@@ -0,0 +1,117 @@
+'''
+The files written by handles, with optional streaming compression and rotation
+
+@author: diego
+'''
+import gzip
+import os
+import time
+
+try:
+    import zstandard
+except ImportError: # optional, only needed for zstd output
+    zstandard = None
+
+FORMATS = ('plain', 'gzip', 'zstd')
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+def check_format(format: str):
+    '''throws ValueError if the format can't be written'''
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if format == 'zstd' and zstandard is None:
+        raise ValueError("zstd output needs the 'zstandard' package installed")
+
+def write_all(raw, data):
+    '''writes the whole buffer to an unbuffered file, which may accept less than asked'''
+    view = memoryview(data)
+    while view:
+        view = view[raw.write(view):]
+
+def segment_path(path, started: float):
+    '''name of a finished rotation segment: out.jsonl.gz -> out-20221018-130501.jsonl.gz'''
+    folder, base = os.path.split(path)
+    name, dot, suffix = base.partition('.')
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started))
+    
+    candidate = os.path.join(folder, f"{name}-{stamp}{dot}{suffix}")
+    n = 1
+    while os.path.exists(candidate):
+        candidate = os.path.join(folder, f"{name}-{stamp}-{n}{dot}{suffix}")
+        n += 1
+    return candidate
+
+class OutputFile():
+    '''Byte sink of a writer. Compresses what is written when a format is given and, when
+    rotate_size bytes or rotate_interval seconds are reached, closes the current segment
+    and renames it from '<path>.part' to a timestamped name so readers only see whole files'''
+    backlog = 0 # everything written is on disk, unlike a sink
+    
+    def __init__(self, path, format='plain', level=None, rotate_size=None, rotate_interval=None):
+        check_format(format)
+        self.path = path
+        self.format = format
+        self.level = level if level is not None else DEFAULT_LEVELS.get(format)
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.segments = 0 # finished segments
+        self._raw = None
+        self._stream = None
+        self._started = 0.0
+        
+    @property
+    def rotating(self):
+        return bool(self.rotate_size or self.rotate_interval)
+    
+    @property
+    def closed(self):
+        return self._raw is None
+        
+    def open(self):
+        '''opens a new segment, or the path itself when not rotating'''
+        self._started = time.time()
+        # a path reopened when the stream starts again is appended to, compressed streams can be concatenated
+        self._raw = open(f"{self.path}.part" if self.rotating else self.path, 'wb' if self.rotating else 'ab', buffering=0)
+        
+        match self.format:
+            case 'gzip':
+                self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=self.level, mtime=0)
+            case 'zstd':
+                self._stream = zstandard.ZstdCompressor(level=self.level).stream_writer(self._raw, closefd=False)
+            case _:
+                self._stream = None
+                
+    def write(self, data) -> int:
+        '''returns the number of uncompressed bytes written'''
+        if self._stream is None:
+            write_all(self._raw, data)
+        else:
+            self._stream.write(data)
+        
+        if self.rotating and self._should_rotate():
+            self.rotate()
+        return len(data)
+            
+    def _should_rotate(self):
+        if self.rotate_size and self._raw.tell() >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval) and time.time() - self._started >= self.rotate_interval
+    
+    def rotate(self):
+        '''finishes the current segment and starts the next'''
+        self.close()
+        self.open()
+        
+    def close(self):
+        '''ends the compressed stream, closes the file and publishes the segment'''
+        if self._raw is None:
+            return
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._raw.close()
+        self._raw = None
+        
+        if self.rotating:
+            os.replace(f"{self.path}.part", segment_path(self.path, self._started))
+            self.segments += 1
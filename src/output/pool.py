@@ -0,0 +1,184 @@
+'''
+Moves the disk writes of handles off the event loop and onto a pool of writer threads.
+The loop only fills the bytearray of a writer and hands finished batches to a bounded queue
+
+@author: diego
+'''
+from output.buffer import BufferedWriter, WriterStats
+from output.files import OutputFile, write_all
+from collections import deque
+from dataclasses import dataclass
+import threading
+import traceback
+import time
+
+# What to do with a batch when the queue of a writer is full
+BLOCK = 'block' # wait for the writer thread, which stops reading from the stream
+DROP_OLDEST = 'drop' # forget the oldest queued batch
+SPILL = 'spill' # append the batch to an overflow file next to the output
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+@dataclass
+class ThreadedWriterStats(WriterStats):
+    '''WriterStats with the counters of the queue'''
+    queue_depth: int = 0 # batches waiting for the writer thread
+    blocked_seconds: float = 0.0
+    dropped_bytes: int = 0
+    spilled_bytes: int = 0
+    errors: int = 0
+    
+    def __str__(self):
+        return (f"{WriterStats.__str__(self)}, queue {self.queue_depth}, blocked {self.blocked_seconds:.2f}s, "
+                f"dropped {self.dropped_bytes}B, spilled {self.spilled_bytes}B, errors {self.errors}")
+
+class WriterThread(threading.Thread):
+    '''Services the queues of the writers assigned to it, one batch per writer per pass
+    so a busy writer can't starve the others'''
+    
+    def __init__(self, index):
+        threading.Thread.__init__(self, name=f"writer-{index}", daemon=True)
+        self.cond = threading.Condition()
+        self.writers: list = list()
+        self._closing = False
+        
+    def _has_work(self):
+        return any(writer._queue for writer in self.writers)
+        
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self._closing or self._has_work())
+                work = [(writer, writer._queue.popleft()) for writer in self.writers if writer._queue]
+                if not work:
+                    return # closing with nothing left
+                for writer, _ in work:
+                    writer._in_flight += 1
+                self.cond.notify_all() # room in the queues for blocked producers
+            
+            for writer, batch in work:
+                writer._write_batch(batch)
+                
+            with self.cond:
+                for writer, _ in work:
+                    writer._in_flight -= 1
+                self.cond.notify_all() # writers waiting to close
+    
+    def stop(self):
+        '''finishes the queued batches and ends the thread'''
+        with self.cond:
+            self._closing = True
+            self.cond.notify_all()
+        self.join()
+
+class WriterPool():
+    '''A fixed number of writer threads shared by all the threaded writers'''
+    
+    def __init__(self, size: int):
+        self.threads = [WriterThread(i) for i in range(max(1, size))]
+        for thread in self.threads:
+            thread.start()
+            
+    def assign(self, writer) -> WriterThread:
+        '''gives the writer to the thread with the fewest writers, which keeps its batches in order'''
+        thread = min(self.threads, key=lambda t: len(t.writers))
+        with thread.cond:
+            thread.writers.append(writer)
+        return thread
+    
+    def release(self, writer):
+        thread = writer._thread
+        with thread.cond:
+            thread.writers.remove(writer)
+            
+    def close(self):
+        for thread in self.threads:
+            thread.stop()
+
+class ThreadedWriter(BufferedWriter):
+    '''BufferedWriter whose flushes are queued to a writer thread instead of written on the loop'''
+    
+    def __init__(self, output: OutputFile, pool: WriterPool, flush_size=1 << 16, flush_interval=1.0, 
+                 backpressure=BLOCK, max_batches=64):
+        if backpressure not in POLICIES:
+            raise ValueError(f"backpressure must be one of {', '.join(POLICIES)}")
+        
+        BufferedWriter.__init__(self, output, flush_size, flush_interval)
+        self.stats = ThreadedWriterStats()
+        self.pool = pool
+        self.backpressure = backpressure
+        self.max_batches = max_batches
+        self._queue = deque()
+        self._in_flight = 0
+        self._thread = None
+        self._overflow = None
+        
+    def open(self):
+        BufferedWriter.open(self)
+        self._thread = self.pool.assign(self)
+        
+    def flush(self):
+        '''hands the buffer to the writer thread, applying the backpressure policy when the queue is full'''
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        
+        batch = bytes(self._buffer)
+        self._buffer.clear()
+        self._submit(batch)
+        
+    def _submit(self, batch):
+        '''queues a batch for the writer thread'''
+        cond = self._thread.cond
+        with cond:
+            if len(self._queue) >= self.max_batches:
+                match self.backpressure:
+                    case 'block':
+                        start = time.perf_counter()
+                        cond.wait_for(lambda: len(self._queue) < self.max_batches)
+                        self.stats.blocked_seconds += time.perf_counter() - start
+                    case 'drop':
+                        self.stats.dropped_bytes += self._size(self._queue.popleft())
+                    case 'spill':
+                        self._spill(batch)
+                        return
+            self._queue.append(batch)
+            self.stats.queue_depth = len(self._queue)
+            cond.notify_all()
+            
+    def _size(self, batch):
+        '''size of a batch in the units of the counters'''
+        return len(batch)
+            
+    def _spill(self, batch):
+        '''writes a batch that didn't fit in the queue to the overflow file, on the calling thread'''
+        if self._overflow is None:
+            self._overflow = open(f"{self.output.path}.overflow", 'ab', buffering=0)
+        write_all(self._overflow, batch)
+        self.stats.spilled_bytes += len(batch)
+        
+    def _write_batch(self, batch):
+        '''called by the writer thread'''
+        start = time.perf_counter()
+        try:
+            size = self.output.write(batch)
+        except Exception:
+            self.stats.errors += 1
+            traceback.print_exc()
+            return
+        self.stats.record_flush(size, time.perf_counter() - start)
+        self.stats.queue_depth = len(self._queue)
+        
+    def close(self):
+        '''queues what's left, waits for the writer thread to write it and closes the files'''
+        if self.output.closed:
+            return
+        self.flush()
+        cond = self._thread.cond
+        with cond:
+            cond.wait_for(lambda: not self._queue and not self._in_flight)
+        self.pool.release(self)
+        
+        self.output.close()
+        if self._overflow is not None:
+            self._overflow.close()
+            self._overflow = None
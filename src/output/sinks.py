@@ -0,0 +1,363 @@
+'''
+Sinks send the lines of a handle straight to another local process instead of a file. The file
+of a handle picks one by its scheme:
+
+    unix:///tmp/tweets.sock        unix domain socket
+    tcp://127.0.0.1:9000           TCP, ?framing=length sends a 4 byte big-endian length before each tweet
+    fifo:///tmp/tweets.pipe        named pipe, reopened when its reader comes back
+    redis://127.0.0.1:6379/tweets  RPUSH onto the list 'tweets' of a Redis compatible server
+    zmq+tcp://127.0.0.1:5555       ZeroMQ PUSH socket, also zmq+ipc:///tmp/tweets.ipc, needs pyzmq
+
+Other paths are files. Sinks never block the writer: what the other process doesn't take
+right away waits in a buffer of ?buffer=<bytes> (8M), dropping the oldest tweets when it's full,
+and the connection is retried every ?retry=<seconds> (1) while it's down
+
+@author: diego
+'''
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+try:
+    import zmq
+except ImportError: # optional, only needed for zmq sinks
+    zmq = None
+
+SCHEMES = ('unix', 'tcp', 'fifo', 'redis', 'zmq+tcp', 'zmq+ipc')
+FRAMINGS = ('newline', 'length')
+DEFAULT_BUFFER = 8 << 20
+
+def is_sink(path: str) -> bool:
+    '''whether a handle's file names a sink rather than a file'''
+    return urlsplit(path).scheme in SCHEMES
+
+def _split(uri: str):
+    '''scheme, address and options of a sink uri, throws ValueError when malformed'''
+    parts = urlsplit(uri)
+    options = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+    unknown = set(options) - {'framing', 'buffer', 'retry'}
+    if unknown:
+        raise ValueError(f"unknown sink options {', '.join(sorted(unknown))}, use framing, buffer or retry")
+    if options.get('framing', 'newline') not in FRAMINGS:
+        raise ValueError(f"framing must be one of {', '.join(FRAMINGS)}")
+    try:
+        kwargs = dict(framing=options.get('framing', 'newline'), retry=float(options.get('retry', 1.0)))
+        if 'buffer' in options:
+            units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+            size = options['buffer'].upper()
+            kwargs['max_buffer'] = int(size[:-1]) * units[size[-1]] if size[-1] in units else int(size)
+    except ValueError:
+        raise ValueError("buffer and retry need numbers, EX: ?buffer=16M&retry=0.5")
+
+    match parts.scheme:
+        case 'unix' | 'fifo':
+            if not parts.path:
+                raise ValueError(f"{parts.scheme} sinks need a path, EX: {parts.scheme}:///tmp/tweets")
+            address = parts.path
+        case 'tcp' | 'redis':
+            try:
+                port = parts.port
+            except ValueError:
+                port = None
+            if not parts.hostname or (port is None and parts.scheme == 'tcp'):
+                raise ValueError(f"{parts.scheme} sinks need a host and port, EX: tcp://127.0.0.1:9000")
+            address = (parts.hostname, port or 6379)
+        case _: # zmq
+            if zmq is None:
+                raise ValueError("zmq sinks need the 'pyzmq' package installed")
+            transport = parts.scheme.partition('+')[2]
+            address = f"{transport}://{parts.netloc}{parts.path}"
+    return parts, address, kwargs
+
+def check_sink(uri: str):
+    '''throws ValueError if the sink can't be used'''
+    _split(uri)
+
+def open_sink(uri: str):
+    '''the sink a uri names, to be opened by its writer'''
+    parts, address, kwargs = _split(uri)
+    match parts.scheme:
+        case 'unix':
+            return SocketSink(uri, socket.AF_UNIX, address, **kwargs)
+        case 'tcp':
+            return SocketSink(uri, socket.AF_INET6 if ':' in address[0] else socket.AF_INET, address, **kwargs)
+        case 'fifo':
+            return FifoSink(uri, address, **kwargs)
+        case 'redis':
+            key = parts.path.strip('/') or 'tweets'
+            kwargs.pop('framing')
+            return RedisSink(uri, socket.AF_INET6 if ':' in address[0] else socket.AF_INET, address, key, **kwargs)
+        case _:
+            kwargs.pop('framing')
+            return ZmqSink(uri, address, **kwargs)
+
+class Sink():
+    '''Byte sink of a writer, like OutputFile, that hands the lines to another process. Frames
+    it couldn't send yet are kept in order and sent on the next write or tick, the lock
+    lets a writer thread write while the loop ticks'''
+
+    def __init__(self, path, framing='newline', max_buffer=DEFAULT_BUFFER, retry=1.0):
+        self.path = path
+        self.framing = framing
+        self.max_buffer = max_buffer # bytes of frames waiting for the other process
+        self.retry = retry # seconds between connection attempts
+        self.dropped = 0 # bytes of frames dropped because the buffer was full
+        self.reconnects = 0
+        self._frames = deque() # frames not sent yet, the first one maybe in part
+        self._offset = 0 # bytes of the first frame already sent
+        self._backlog = 0 # bytes still to send
+        self._conn = None # socket or file descriptor, None while disconnected
+        self._established = False # the connection took data, a refused TCP connect only shows on the first send
+        self._ever_established = False
+        self._next_attempt = 0.0
+        self._open = False
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return not self._open
+
+    @property
+    def connected(self):
+        return self._established
+
+    @property
+    def backlog(self):
+        '''bytes waiting to be sent'''
+        return self._backlog
+
+    @property
+    def status(self):
+        return "{}, backlog {}B, dropped {}B, {} reconnects".format('connected' if self.connected else 'disconnected',
+                                                                  self._backlog, self.dropped, self.reconnects)
+
+    def open(self):
+        self._open = True
+        with self._lock:
+            self._send()
+
+    def _frame(self, data) -> list:
+        '''the frames of a batch of lines'''
+        if self.framing == 'newline':
+            return [bytes(data)]
+        return [struct.pack('>I', len(line)) + line for line in bytes(data).split(b"\n") if line]
+
+    def write(self, data) -> int:
+        '''queues the lines and sends what the other process takes now, returns the bytes accepted'''
+        frames = self._frame(data)
+        with self._lock:
+            for frame in frames:
+                self._frames.append(frame)
+                self._backlog += len(frame)
+            while self._backlog > self.max_buffer and len(self._frames) > 1: # the one in part can't be dropped
+                index = 1 if self._offset else 0
+                frame = self._frames[index]
+                del self._frames[index]
+                self._backlog -= len(frame)
+                self.dropped += len(frame)
+            self._send()
+        return len(data)
+
+    def drain(self):
+        '''sends what's waiting, called when no lines are arriving'''
+        with self._lock:
+            self._send()
+
+    def _send(self):
+        '''sends frames until the other process stops taking them, connecting first when due'''
+        if self._conn is None:
+            now = time.monotonic()
+            if now < self._next_attempt:
+                return
+            try:
+                self._conn = self._connect()
+            except OSError:
+                self._next_attempt = now + self.retry
+                return
+
+        try:
+            self._receive()
+            while self._frames:
+                frame = self._frames[0]
+                sent = self._send_some(memoryview(frame)[self._offset:])
+                if not self._established:
+                    self.reconnects += self._ever_established
+                    self._established = self._ever_established = True
+                self._offset += sent
+                self._backlog -= sent
+                if self._offset < len(frame):
+                    return
+                self._frames.popleft()
+                self._offset = 0
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._lost()
+
+    def _lost(self):
+        '''the connection dropped, a frame sent in part is sent whole on the next one'''
+        self._disconnect()
+        self._conn = None
+        self._established = False
+        self._backlog += self._offset
+        self._offset = 0
+        self._next_attempt = time.monotonic() + self.retry
+
+    def close(self):
+        '''sends what the other process takes right away and disconnects, the rest is dropped'''
+        if not self._open:
+            return
+        with self._lock:
+            self._send()
+            if self._conn is not None:
+                self._disconnect()
+                self._conn = None
+                self._established = False
+            self.dropped += self._backlog
+            self._frames.clear()
+            self._offset = self._backlog = 0
+        self._open = False
+
+    def _connect(self):
+        '''returns the new connection, throws OSError when the other process isn't there'''
+        raise NotImplementedError
+
+    def _send_some(self, data) -> int:
+        '''sends part of data, throws BlockingIOError when nothing can be sent now'''
+        raise NotImplementedError
+
+    def _receive(self):
+        '''reads what the other process answered, throws OSError when it's gone'''
+
+    def _disconnect(self):
+        raise NotImplementedError
+
+class SocketSink(Sink):
+    '''Non-blocking stream socket, unix or TCP'''
+
+    def __init__(self, path, family, address, **kwargs):
+        Sink.__init__(self, path, **kwargs)
+        self.family = family
+        self.address = address
+        self._connecting = False
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if self.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = sock.connect_ex(self.address)
+        if error not in (0, errno.EINPROGRESS):
+            sock.close()
+            raise OSError(error, os.strerror(error))
+        self._connecting = error != 0
+        return sock
+
+    def _send_some(self, data) -> int:
+        if self._connecting: # a TCP connect finishes when the socket turns writable
+            if not select.select((), (self._conn,), (), 0)[1]:
+                raise BlockingIOError()
+            error = self._conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise OSError(error, os.strerror(error))
+            self._connecting = False
+        return self._conn.send(data)
+
+    def _receive(self):
+        '''nothing is expected back, an empty read means the other end closed'''
+        if self._connecting:
+            return
+        try:
+            if self._conn.recv(1 << 16) == b"":
+                raise ConnectionResetError()
+        except BlockingIOError:
+            pass
+
+    def _disconnect(self):
+        self._conn.close()
+
+class RedisSink(SocketSink):
+    '''Pushes each batch onto a list with one RPUSH in the Redis protocol, so any
+    Redis compatible server works as the queue without a client library'''
+
+    def __init__(self, path, family, address, key, **kwargs):
+        SocketSink.__init__(self, path, family, address, **kwargs)
+        self.key = key.encode()
+        self.errors = 0 # commands the server refused
+
+    def _frame(self, data) -> list:
+        lines = [line for line in bytes(data).split(b"\n") if line]
+        parts = [b"*%d\r\n$5\r\nRPUSH\r\n$%d\r\n%s\r\n" % (len(lines) + 2, len(self.key), self.key)]
+        for line in lines:
+            parts.append(b"$%d\r\n%s\r\n" % (len(line), line))
+        return [b"".join(parts)]
+
+    def _receive(self):
+        '''the replies are only counted, errors start with '-' '''
+        if self._connecting:
+            return
+        try:
+            replies = self._conn.recv(1 << 16)
+        except BlockingIOError:
+            return
+        if replies == b"":
+            raise ConnectionResetError()
+        self.errors += replies.count(b"\r\n-") + replies.startswith(b"-")
+
+    @property
+    def status(self):
+        return "{}, {} errors".format(Sink.status.fget(self), self.errors)
+
+class FifoSink(Sink):
+    '''Named pipe, created if missing. Opening it fails until a reader has it open'''
+
+    def __init__(self, path, fifo, **kwargs):
+        Sink.__init__(self, path, **kwargs)
+        self.fifo = fifo
+
+    def _connect(self):
+        if not os.path.exists(self.fifo):
+            os.mkfifo(self.fifo)
+        return os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK) # ENXIO without a reader
+
+    def _send_some(self, data) -> int:
+        return os.write(self._conn, data)
+
+    def _disconnect(self):
+        os.close(self._conn)
+
+class ZmqSink(Sink):
+    '''ZeroMQ PUSH socket, one message per tweet. ZeroMQ reconnects by itself,
+    the buffer holds the messages its own queue has no room for'''
+
+    def __init__(self, path, endpoint, **kwargs):
+        Sink.__init__(self, path, **kwargs)
+        self.endpoint = endpoint
+
+    def _frame(self, data) -> list:
+        return [line for line in bytes(data).split(b"\n") if line]
+
+    def _connect(self):
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, int(self.retry * 1000))
+        sock.setsockopt(zmq.SNDHWM, 1000)
+        sock.connect(self.endpoint)
+        return sock
+
+    def _send_some(self, data) -> int:
+        try:
+            self._conn.send(data, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            raise BlockingIOError()
+        except zmq.ZMQError as e:
+            raise OSError(e.errno, str(e))
+        return len(data)
+
+    def _disconnect(self):
+        self._conn.close()
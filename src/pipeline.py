@@ -0,0 +1,254 @@
+'''
+Parses, routes and encodes tweets on a pool of worker processes. The event loop only
+collects lines from the stream into batches and writes the buffers the workers send back,
+so the CPU work of a stream spreads over several cores
+
+@author: diego
+'''
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from orjson import orjson
+from net.packing import demux
+from net.utils import Unauthorized
+from tweet import Tweet
+import fields as field_selection
+import asyncio
+import multiprocessing
+import pickle
+import time
+import traceback
+
+### WORKER SIDE
+_PLAN = None # (rule id -> handle ids, handle id -> (raw, columnar, fields, predicate), KeywordMatcher, packed rules)
+_PLAN_VERSION = None
+_CACHE: dict[tuple, tuple] = dict() # combinations of rule ids to handle ids, like globals._DISPATCH_CACHE
+
+def _route(rules_handle, matching):
+    if len(matching) == 1:
+        return rules_handle.get(matching[0]['id'], ())
+    
+    key = tuple([rule['id'] for rule in matching])
+    handles = _CACHE.get(key)
+    if handles is None:
+        merged = dict()
+        for rule_id in key:
+            for handle_id in rules_handle.get(rule_id, ()):
+                merged[handle_id] = None
+        handles = _CACHE[key] = tuple(merged)
+    return handles
+
+def process_batch(version, plan: bytes, lines: list, dedup: bool, record=False):
+    '''runs in a worker: parses a batch of lines and encodes every tweet for the handles it goes to.
+    
+    return (outputs, rows, ids, errors, tweets, seconds, matched) where outputs maps a handle id to its bytes, 
+    or to (line index, bytes) pieces when dedup is set, rows maps columnar handle ids to (line index, data,
+    matching rules, size), ids lists the (line index, tweet id) pairs when dedup is set and matched
+    the (line index, matching rule ids) pairs when record is set
+    '''
+    global _PLAN, _PLAN_VERSION
+    if version != _PLAN_VERSION:
+        _PLAN = pickle.loads(plan)
+        _PLAN_VERSION = version
+        _CACHE.clear()
+    rules_handle, specs, keywords, packed = _PLAN
+    
+    start = time.perf_counter()
+    outputs = dict()
+    rows = dict()
+    ids = list() if dedup else None
+    matched = list() if record else None
+    errors = list()
+    
+    for index, line in enumerate(lines):
+        tweet = Tweet(line)
+        if not tweet.is_tweet:
+            errors.append(tweet.errors)
+            continue
+        if dedup:
+            ids.append((index, tweet.id))
+        
+        matching = tweet.matching
+        if packed:
+            matching = demux(matching, tweet.response, packed)
+        if record:
+            matched.append((index, [rule['id'] for rule in matching]))
+        data = None
+        raw = None
+        projected = None
+        found = None
+        for handle_id in _route(rules_handle, matching):
+            is_raw, columnar, fields, predicate = specs[handle_id]
+            if predicate is not None:
+                if found is None and predicate.keywords is not None:
+                    found = keywords.match(tweet.data.get('text', ''))
+                if not predicate.accepts(tweet.data, found):
+                    continue
+            if columnar:
+                rows.setdefault(handle_id, []).append((index, tweet.data, matching, len(line)))
+                continue
+            if is_raw:
+                if raw is None:
+                    raw = line.rstrip() + b"\n"
+                piece = raw
+            elif fields is not None:
+                if projected is None:
+                    projected = dict()
+                piece = projected.get(fields)
+                if piece is None:
+                    piece = projected[fields] = orjson.dumps(field_selection.projection(fields).project(tweet.response),
+                                                             option=orjson.OPT_APPEND_NEWLINE)
+            else:
+                if data is None:
+                    data = orjson.dumps(tweet.data, option=orjson.OPT_APPEND_NEWLINE)
+                piece = data
+            outputs.setdefault(handle_id, []).append((index, piece) if dedup else piece)
+            
+    if not dedup:
+        outputs = {handle_id: b"".join(pieces) for handle_id, pieces in outputs.items()}
+    return outputs, rows, ids, errors, len(lines) - len(errors), time.perf_counter() - start, matched
+
+### LOOP SIDE
+class Pipeline():
+    '''Replaces process_tweets when streaming with worker processes. Batches are applied in the
+    order they were read when ordered is set, otherwise as soon as their worker is done'''
+    
+    def __init__(self, workers: int, ordered=True, batch_size=512):
+        self.workers = workers
+        self.ordered = ordered
+        self.batch_size = batch_size # lines per batch, smaller batches are sent while workers are idle
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self._pending = deque() # [future, time read, dedup cache, delivered ids, size, lines to record] in the order submitted
+        self._plan = None
+        self._plan_version = None
+        self._loop = None
+        self._batch = list() # lines read and not sent to a worker yet
+        self._dedup = (None, None) # recent and delivered of the stream
+        self._closing = False
+        
+    def _current_plan(self):
+        '''the pickled routing table, rebuilt when the dispatch table changed'''
+        import globals
+        
+        version = globals.dispatch_version()
+        if version != self._plan_version:
+            rules_handle = {rule_id: tuple(handle.id for handle in handles) 
+                            for rule_id, handles in globals.RULES_HANDLE.items()}
+            specs = {handle.id: (handle.raw, handle.columnar, handle.fields, handle.predicate) 
+                     for handle in globals.HANDLES.values()}
+            self._plan = pickle.dumps((rules_handle, specs, globals.KEYWORDS, globals.PACKED))
+            self._plan_version = version
+        return self._plan_version, self._plan
+    
+    async def run(self, stream, running):
+        '''regroups the batches read from the stream into batches for the workers until running() is False'''
+        import globals
+        
+        self._loop = asyncio.get_running_loop()
+        self._dedup = (stream.recent, stream.delivered)
+        try:
+            async for lines in stream.batches():
+                if not running():
+                    stream.stop()
+                    return
+                
+                for line in lines:
+                    if line.strip():
+                        self._batch.append(line)
+                    else: # keep-alive
+                        globals.METRICS.heartbeat(len(line))
+                        for handle in globals.HANDLES.values():
+                            handle.tick()
+                    
+                # full batches, or whatever is there when a worker has nothing to do
+                if self._batch and (len(self._batch) >= self.batch_size or len(self._pending) < self.workers):
+                    await self._submit()
+                await asyncio.sleep(0)
+        except Unauthorized:
+            globals.stream_unauthorized()
+        except Exception:
+            traceback.print_exc()
+            
+    async def _submit(self):
+        while len(self._pending) >= self.workers * 2: # don't read faster than the workers keep up
+            await asyncio.wrap_future(self._pending[0][0])
+            self._drain()
+        if not self._closing: # close() sent the batch itself
+            self._send()
+            
+    def _send(self):
+        '''hands the batch to a worker'''
+        import globals
+        
+        batch, self._batch = self._batch, list()
+        recent, delivered = self._dedup
+        version, plan = self._current_plan()
+        dedup = recent is not None or delivered is not None
+        record = globals.RING is not None
+        future = self.executor.submit(process_batch, version, plan, batch, dedup, record)
+        self._pending.append([future, time.time(), recent, delivered, sum(map(len, batch)), batch if record else None])
+        future.add_done_callback(lambda _: self._loop.call_soon_threadsafe(self._drain))
+        
+    def _drain(self):
+        '''applies the finished batches, stopping at the first unfinished one when ordered'''
+        if self.ordered:
+            while self._pending and self._pending[0][0].done():
+                self._apply(*self._pending.popleft())
+        else:
+            for entry in [entry for entry in self._pending if entry[0].done()]:
+                self._pending.remove(entry)
+                self._apply(*entry)
+                
+    def _apply(self, future, received, recent, delivered, size, lines):
+        '''writes the output of a worker to the handles'''
+        import globals
+        
+        try:
+            outputs, rows, ids, errors, tweets, seconds, matched = future.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        for error in errors:
+            print(f"\nStream error: {error}")
+            
+        start = time.perf_counter()
+        duplicates = {index for index, id in ids if recent.seen(id)} if recent is not None else None
+        tweet_ids = dict(ids) if delivered is not None else None # line index -> tweet id
+        if matched is not None and globals.RING is not None:
+            for index, rule_ids in matched:
+                if not duplicates or index not in duplicates:
+                    globals.RING.append(lines[index].rstrip(), rule_ids, received)
+        
+        def keep(index, handle_id):
+            if duplicates and index in duplicates:
+                return False
+            return tweet_ids is None or delivered.first(tweet_ids[index], handle_id)
+        
+        for handle_id, output in outputs.items():
+            handle = globals.get_handle_by_id(handle_id)
+            if handle is None or handle.writer is None:
+                continue
+            if ids is not None:
+                output = b"".join([piece for index, piece in output if keep(index, handle_id)])
+            if output:
+                handle.write(output)
+                
+        for handle_id, handle_rows in rows.items():
+            handle = globals.get_handle_by_id(handle_id)
+            if handle is None or handle.writer is None:
+                continue
+            for index, data, matching, line_size in handle_rows:
+                if ids is None or keep(index, handle_id):
+                    handle.append(data, matching, received, line_size)
+        
+        if duplicates:
+            tweets -= len(duplicates)
+        globals.METRICS.batch(tweets, size, seconds, time.perf_counter() - start)
+        
+    def close(self):
+        '''waits for the batches in the workers and writes them, then stops the workers'''
+        self._closing = True
+        if self._batch: # already read from the socket
+            self._send()
+        self.executor.shutdown(wait=True)
+        while self._pending:
+            self._apply(*self._pending.popleft())
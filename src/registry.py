@@ -0,0 +1,129 @@
+'''
+Indexes of the rules and handles, so looking one up by name or finding the handles
+of a rule doesn't scan every entry. They're kept consistent on every change instead
+of being rebuilt when the stream starts
+
+@author: diego
+'''
+
+class Registry():
+    '''Objects by id with an index of their names. Reads like the dict of ids it replaces'''
+
+    def __init__(self):
+        self._objects = dict() # id -> object
+        self._names = dict() # name -> id
+
+    def add(self, obj):
+        '''adds or replaces the object with obj.id'''
+        old = self._objects.get(obj.id)
+        if old is not None and self._names.get(old.name) == obj.id:
+            del self._names[old.name]
+        self._objects[obj.id] = obj
+        self._names[obj.name] = obj.id
+
+    def remove(self, id):
+        '''removes and returns the object with id'''
+        obj = self._objects.pop(id)
+        if self._names.get(obj.name) == id:
+            del self._names[obj.name]
+        return obj
+
+    pop = remove
+
+    def rename(self, id, name):
+        '''changes the name of an object, keeping the index right'''
+        obj = self._objects[id]
+        if self._names.get(obj.name) == id:
+            del self._names[obj.name]
+        obj.name = name
+        self._names[name] = id
+
+    def reid(self, old, new):
+        '''changes the id of an object, keeping the index right'''
+        obj = self.remove(old)
+        obj.id = new
+        self.add(obj)
+        return obj
+
+    def get(self, id, default=None):
+        return self._objects.get(id, default)
+
+    def by_name(self, name):
+        '''the object with name, None if there isn't one'''
+        id = self._names.get(name)
+        return None if id is None else self._objects[id]
+
+    def has_name(self, name):
+        return name in self._names
+
+    def clear(self):
+        self._objects.clear()
+        self._names.clear()
+
+    def keys(self):
+        return self._objects.keys()
+
+    def values(self):
+        return self._objects.values()
+
+    def items(self):
+        return self._objects.items()
+
+    def __getitem__(self, id):
+        return self._objects[id]
+
+    def __contains__(self, id):
+        return id in self._objects
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def __len__(self):
+        return len(self._objects)
+
+class Subscriptions():
+    '''Reverse index of the handles following each rule, handles following no rule get every tweet.
+    Dicts are used as ordered sets so the handles come out in the order they subscribed'''
+
+    def __init__(self):
+        self.by_rule: dict[str, dict] = dict() # rule id -> handle ids
+        self.everything: dict = dict() # ids of the handles that want every tweet
+
+    def follow(self, handle_id, rule_ids):
+        '''the handle gets the tweets of rule_ids, of every rule when rule_ids is empty'''
+        if not rule_ids:
+            self.everything[handle_id] = None
+            return
+        for rule_id in rule_ids:
+            self.by_rule.setdefault(rule_id, dict())[handle_id] = None
+
+    def unfollow(self, handle_id, rule_ids):
+        '''undoes follow'''
+        if not rule_ids:
+            self.everything.pop(handle_id, None)
+            return
+        for rule_id in rule_ids:
+            handles = self.by_rule.get(rule_id)
+            if handles is not None:
+                handles.pop(handle_id, None)
+                if not handles:
+                    del self.by_rule[rule_id]
+
+    def reid(self, old, new):
+        '''follows a rule whose id changed'''
+        handles = self.by_rule.pop(old, None)
+        if handles is not None:
+            self.by_rule[new] = handles
+
+    def handles(self, rule_id) -> list:
+        '''ids of the handles that get the tweets of a rule'''
+        handles = self.by_rule.get(rule_id)
+        if not handles:
+            return list(self.everything)
+        if not self.everything:
+            return list(handles)
+        return list({**handles, **self.everything})
+
+    def clear(self):
+        self.by_rule.clear()
+        self.everything.clear()
@@ -0,0 +1,89 @@
+'''
+Keeps the most recent tweets in a fixed amount of memory, so a handle added while streaming can
+be replayed what it missed and 'tail' can show what's arriving. The lines are copied into one
+preallocated arena used as a ring: the newest tweet overwrites the oldest ones in its way
+
+@author: diego
+'''
+from collections import deque
+import struct
+import time
+
+_HEADER = struct.Struct('<dHI') # received, length of the rule ids, length of the line
+
+class TweetRing():
+    '''Arena of size bytes holding (received, matching rule ids, raw line) entries, oldest first.
+    Entries older than max_age seconds are dropped too when it's given'''
+
+    def __init__(self, size: int, max_age: float = None):
+        self.size = size
+        self.max_age = max_age
+        self.evicted = 0 # entries overwritten or expired
+        self.skipped = 0 # lines bigger than the arena
+        self._arena = bytearray(size)
+        self._index = deque() # (start, end, received) of the entries, oldest first
+        self._pos = 0 # where the next entry goes
+        self.used = 0 # bytes taken by the entries
+
+    def __len__(self):
+        return len(self._index)
+
+    def _evict(self):
+        start, end, _ = self._index.popleft()
+        self.used -= end - start
+        self.evicted += 1
+
+    def append(self, line: bytes, rule_ids, received: float):
+        '''stores a tweet, evicting the oldest entries it overlaps'''
+        ids = ",".join(rule_ids).encode()
+        length = _HEADER.size + len(ids) + len(line)
+        if length > self.size:
+            self.skipped += 1
+            return
+        if self._pos + length > self.size: # doesn't fit before the end, the entries after pos are the oldest
+            while self._index and self._index[0][0] >= self._pos:
+                self._evict()
+            self._pos = 0
+        while self._index and self._pos <= self._index[0][0] < self._pos + length:
+            self._evict()
+        if self.max_age is not None:
+            while self._index and self._index[0][2] < received - self.max_age:
+                self._evict()
+
+        start = self._pos
+        _HEADER.pack_into(self._arena, start, received, len(ids), len(line))
+        offset = start + _HEADER.size
+        self._arena[offset:offset + len(ids)] = ids
+        offset += len(ids)
+        self._arena[offset:offset + len(line)] = line
+        self._index.append((start, start + length, received))
+        self._pos = start + length
+        self.used += length
+
+    def _read(self, start):
+        '''the entry at start of the arena'''
+        received, ids_length, line_length = _HEADER.unpack_from(self._arena, start)
+        offset = start + _HEADER.size
+        ids = bytes(self._arena[offset:offset + ids_length]).decode()
+        offset += ids_length
+        return received, tuple(ids.split(",")) if ids else (), bytes(self._arena[offset:offset + line_length])
+
+    def entries(self, since: float = None):
+        '''(received, rule ids, line) of the entries received after since, oldest first'''
+        for start, _, received in self._index:
+            if since is None or received >= since:
+                yield self._read(start)
+
+    def last(self, count: int) -> list:
+        '''the count newest entries, oldest first'''
+        return [self._read(start) for start, _, _ in list(self._index)[-count:]] if count > 0 else []
+
+    def clear(self):
+        self._index.clear()
+        self._pos = 0
+        self.used = 0
+
+    def __str__(self):
+        oldest = time.time() - self._index[0][2] if self._index else 0
+        return "{} tweets, {}/{} bytes, oldest {:.0f}s ago, {} evicted".format(len(self._index), self.used, self.size,
+                                                                               oldest, self.evicted)
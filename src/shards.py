@@ -0,0 +1,281 @@
+'''
+Streams with several apps at once, to go past the rule cap of one app. The rules are placed on
+shards, each a process with its own bearer token, TwitterSession and share of the rules, and the
+tweets the shards receive are read here as one stream and written to the handles of this process.
+A tweet matched on several shards reaches each handle once
+
+@author: diego
+'''
+from collections import deque
+from orjson import orjson
+from net.utils import normalize, Unauthorized
+from tweet import find_matching
+import asyncio
+import multiprocessing
+import os
+import time
+import traceback
+import zlib
+
+PLACEMENTS = ('balanced', 'fill', 'hash')
+MAX_RULES = 1000 # rules of an app, depends on its access level
+MAX_QUEUED = 64 # batches read from the shards and not processed yet before they're made to wait
+STOP_TIMEOUT = 2.0 # seconds all the shards get together to end before they're terminated
+
+class Shard():
+    '''An app the rules can be placed on. Its token is read from the environment when the stream starts'''
+
+    def __init__(self, name, env, max_rules=MAX_RULES):
+        self.name = name
+        self.env = env # environment variable holding the bearer token
+        self.max_rules = max_rules
+        self.rules = 0 # placed when the stream last started
+
+    def token(self) -> str:
+        token = os.environ.get(self.env)
+        if not token:
+            raise ValueError(f"set the bearer token of shard {self.name} in {self.env}")
+        return token
+
+def place(rules: list, shards: list, policy='balanced') -> dict:
+    '''assigns every rule to a shard with room for it, returns shard name -> rules.
+    balanced evens out the number of rules, fill uses a shard up before the next and hash
+    keeps a rule on the same shard across restarts so the apps' rules change the least'''
+    if policy not in PLACEMENTS:
+        raise ValueError(f"placement must be one of {', '.join(PLACEMENTS)}")
+    placed = {shard.name: list() for shard in shards}
+    for rule in rules:
+        match policy:
+            case 'fill':
+                candidates = shards
+            case 'hash':
+                first = zlib.crc32(normalize(rule.rules).encode()) % len(shards)
+                candidates = shards[first:] + shards[:first]
+            case _:
+                candidates = sorted(shards, key=lambda shard: len(placed[shard.name]))
+        for shard in candidates:
+            if len(placed[shard.name]) < shard.max_rules:
+                placed[shard.name].append(rule)
+                break
+        else:
+            raise ValueError(f"{len(rules)} rules don't fit in the shards")
+    return placed
+
+class DeliveredIds():
+    '''Which handles got each recent tweet, the oldest tweets are forgotten first'''
+
+    def __init__(self, size=100000):
+        self.size = size
+        self._handles: dict[str, set] = dict()
+        self._order = deque()
+
+    def first(self, tweet_id, handle_id) -> bool:
+        '''True the first time a tweet goes to a handle'''
+        handles = self._handles.get(tweet_id)
+        if handles is None:
+            handles = self._handles[tweet_id] = set()
+            self._order.append(tweet_id)
+            if len(self._order) > self.size:
+                del self._handles[self._order.popleft()]
+        if handle_id in handles:
+            return False
+        handles.add(handle_id)
+        return True
+
+### SHARD PROCESS
+def _shard_main(token, base_url, rules, params, options, conn):
+    '''entry of a shard's process'''
+    try:
+        asyncio.run(_shard(token, base_url, rules, params, options, conn))
+    except KeyboardInterrupt: # the console's ctrl-c reaches the shards too, the coordinator stops them
+        pass
+    except Unauthorized:
+        conn.send(('unauthorized',))
+    except BaseException as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+
+async def _shard(token, base_url, rules, params, options, conn):
+    '''syncs the app's rules to its share, then streams, sending the batches back
+    with the matching rules named by their ids in the coordinator'''
+    from net.utils import TwitterSession, Rule
+    from net import sync
+
+    session = await TwitterSession(token, base_url)
+    try:
+        local = [Rule(value, tag=tag, id=id) for id, value, tag in rules]
+        ids = [rule.id for rule in local]
+        changes = sync.diff(local, session.initial_rules.get('data', []))
+        for rule, server_id in changes.keep:
+            rule.id = server_id
+        await sync.apply(session, changes) # gives the added rules their ids in this app
+        to_coordinator = {rule.id: id for rule, id in zip(local, ids)}
+
+        supervisor = session.stream(params, dedup_size=0, **options) # delivered dedups in the coordinator
+
+        def control():
+            message = conn.recv()
+            match message:
+                case ('params', params):
+                    supervisor.params = params
+                case _:
+                    supervisor.stop()
+        asyncio.get_running_loop().add_reader(conn.fileno(), control)
+        conn.send(('ready', len(local)))
+
+        async for lines in supervisor.batches():
+            out = list()
+            for line in lines:
+                found = find_matching(line) if line.strip() else None
+                if found is not None: # only the matching rules are rewritten, the tweet is passed on as it came
+                    start, end, matching = found
+                    for rule in matching:
+                        rule['id'] = to_coordinator.get(rule['id'], rule['id'])
+                    line = line[:start] + orjson.dumps(matching) + line[end:]
+                out.append(line)
+            conn.send(('lines', out, supervisor.connected, supervisor.reconnects))
+    finally:
+        await session.close()
+
+### COORDINATOR
+class ShardedStream():
+    '''The streams of the shards read as one, in place of a StreamSupervisor'''
+
+    def __init__(self, shards: list, base_url, params: dict, placement='balanced', stall_timeout=30.0, 
+                 backfill_minutes=0, dedup_size=100000):
+        self.shards = shards
+        self.base_url = base_url
+        self.placement = placement
+        self.options = dict(stall_timeout=stall_timeout, backfill_minutes=backfill_minutes) # of the shards' supervisors
+        self.recent = None # copies are told apart per handle by delivered instead
+        # several shards or a backfill can deliver a tweet more than once
+        self.delivered = DeliveredIds(dedup_size) if len(shards) > 1 or backfill_minutes else None
+        self._params = params
+        self._processes = dict() # shard name -> process
+        self._conns = dict() # shard name -> connection to it
+        self._status = dict() # shard name -> (connected, reconnects)
+        self._queue: asyncio.Queue = None
+        self._paused = False
+        self._stopped = False
+        self._refused = None # name of a shard whose token was refused
+
+    def start(self, rules: list):
+        '''places the rules and starts a process per shard, raises ValueError when the
+        rules don't fit or a token is missing'''
+        placed = place(rules, self.shards, self.placement)
+        tokens = {shard.name: shard.token() for shard in self.shards}
+        context = multiprocessing.get_context('spawn')
+        for shard in self.shards:
+            shard.rules = len(placed[shard.name])
+            conn, child = context.Pipe()
+            share = [(rule.id, rule.rules, rule.tag) for rule in placed[shard.name]]
+            process = context.Process(target=_shard_main, name=f"shard-{shard.name}", daemon=True,
+                                      args=(tokens[shard.name], self.base_url, share, self._params, self.options, child))
+            process.start()
+            child.close()
+            self._processes[shard.name] = process
+            self._conns[shard.name] = conn
+
+    @property
+    def params(self):
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        '''the shards use them when they reconnect'''
+        self._params = params
+        self._send(('params', params))
+
+    @property
+    def connected(self):
+        return any(connected for connected, _ in self._status.values())
+
+    @property
+    def reconnects(self):
+        return sum(reconnects for _, reconnects in self._status.values())
+
+    def _send(self, message):
+        for conn in self._conns.values():
+            try:
+                conn.send(message)
+            except OSError: # that shard is gone
+                pass
+
+    def _receive(self, name, conn):
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            self._drop(name)
+            return
+
+        match message:
+            case ('lines', lines, connected, reconnects):
+                self._status[name] = (connected, reconnects)
+                self._queue.put_nowait(lines)
+                if self._queue.qsize() >= MAX_QUEUED: # the shards wait on their pipes until this catches up
+                    self._pause(True)
+            case ('ready', rules):
+                print(f"\nShard {name} streaming with {rules} rules")
+            case ('error', error):
+                print(f"\nShard {name} stopped: {error}")
+            case ('unauthorized',): # the whole stream stops, as it does for a single app
+                print(f"\nShard {name} stopped: its token was refused")
+                self._refused = name
+                self._queue.put_nowait(None)
+
+    def _drop(self, name):
+        '''a shard whose process ended'''
+        asyncio.get_running_loop().remove_reader(self._conns[name].fileno())
+        self._conns.pop(name).close()
+        self._status.pop(name, None)
+        if not self._conns:
+            self._queue.put_nowait(None)
+
+    def _pause(self, paused):
+        if paused == self._paused:
+            return
+        loop = asyncio.get_running_loop()
+        for name, conn in self._conns.items():
+            if paused:
+                loop.remove_reader(conn.fileno())
+            else:
+                loop.add_reader(conn.fileno(), self._receive, name, conn)
+        self._paused = paused
+
+    async def batches(self):
+        '''yields the lists of lines of every shard as they arrive, until stop() is called or every shard ended'''
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        for name, conn in self._conns.items():
+            loop.add_reader(conn.fileno(), self._receive, name, conn)
+        try:
+            while not self._stopped:
+                lines = await self._queue.get()
+                if lines is None:
+                    if self._refused is not None:
+                        raise Unauthorized(self._refused)
+                    return
+                if self._paused and self._queue.qsize() < MAX_QUEUED // 2:
+                    self._pause(False)
+                yield lines
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        '''stops the shards and waits at most STOP_TIMEOUT for their processes'''
+        if self._stopped:
+            return
+        self._stopped = True
+        self._send(('stop',))
+        if self._queue is not None:
+            self._pause(True)
+            self._queue.put_nowait(None)
+        # a deadline shared by the shards, the loop waits STOP_TIMEOUT at most however many there are
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self._processes.values():
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
@@ -0,0 +1,121 @@
+'''
+Keeps the rules, handles and shards between launches in a small JSON file, saved whenever they change.
+The file remembers a fingerprint of the server's rules, so a restart against unchanged rules
+takes them from the file instead of synchronizing
+
+@author: diego
+'''
+from orjson import orjson
+from net.utils import Rule, normalize
+from net import packing
+from filters import Predicate
+from shards import Shard
+from ring import TweetRing
+import fields as field_selection
+import hashlib
+import globals
+import os
+
+VERSION = 1
+DEFAULT_PATH = "stream_state.json"
+_SAVED: bytes = None # the last state written or read, to only write when something changed
+
+def fingerprint(server_rules: list) -> str:
+    '''digest of the server's rules ('data' of get_rules), the same whatever order they come in'''
+    digest = hashlib.sha1()
+    for rule in sorted(server_rules, key=lambda rule: rule['id']):
+        digest.update(orjson.dumps((rule['id'], normalize(rule['value']), rule.get('tag') or None)))
+    return digest.hexdigest()
+
+def _rule(rule) -> dict:
+    return {"id": rule.id, "name": rule.name, "value": rule.rules, "tag": rule.tag}
+
+def _predicate(predicate: Predicate):
+    if predicate is None:
+        return None
+    return {"keywords": sorted(predicate.keywords) if predicate.keywords else None,
+            "regex": predicate.regex.pattern if predicate.regex else None,
+            "authors": sorted(predicate.authors) if predicate.authors else None,
+            "exclude_authors": sorted(predicate.exclude_authors) if predicate.exclude_authors else None,
+            "lang": sorted(predicate.lang) if predicate.lang else None}
+
+def _handle(handle) -> dict:
+    return {"name": handle.name, "file": handle.file, "rules": sorted(handle.rules),
+            "raw": handle.raw, "flush_size": handle.flush_size, "flush_interval": handle.flush_interval,
+            "threaded": handle.threaded, "backpressure": handle.backpressure, "max_batches": handle.max_batches,
+            "format": handle.format, "level": handle.level, "rotate_size": handle.rotate_size,
+            "rotate_interval": handle.rotate_interval, "row_group_size": handle.row_group_size,
+            "fields": list(handle.fields) if handle.fields else None, "predicate": _predicate(handle.predicate)}
+
+def snapshot(server_rules: list) -> dict:
+    '''the state to save, server_rules is what the server has for the rules in it'''
+    return {"version": VERSION,
+            "fingerprint": fingerprint(server_rules),
+            "rules": [_rule(rule) for rule in globals.RULES.values()],
+            "packed": [dict(_rule(rule), members=[member.id for member in globals.PACKED.get(id, ())])
+                       for id, rule in globals.PACKED_RULES.items()],
+            "handles": [_handle(handle) for handle in globals.HANDLES.values()],
+            # the variables holding the tokens, never the tokens
+            "shards": [{"name": shard.name, "env": shard.env, "max_rules": shard.max_rules} for shard in globals.SHARDS.values()],
+            "placement": globals.SHARD_PLACEMENT,
+            "ring": {"size": globals.RING.size, "max_age": globals.RING.max_age} if globals.RING is not None else None}
+
+def server_view() -> list:
+    '''the server's rules as get_rules would list them when in sync with the local ones'''
+    return [{"id": rule.id, "value": rule.rules, "tag": rule.tag} for rule in globals.server_rules() if rule.id is not None]
+
+def save(path: str):
+    '''writes the state if it changed since the last save or load, replacing the file at once'''
+    global _SAVED
+    data = orjson.dumps(snapshot(server_view()), option=orjson.OPT_INDENT_2)
+    if data == _SAVED:
+        return
+    part = path + ".part"
+    with open(part, 'wb') as f:
+        f.write(data)
+    os.replace(part, path)
+    _SAVED = data
+
+def load(path: str):
+    '''restores the rules, handles and shards of the file, returns the fingerprint it was saved with,
+    None when there's no usable file'''
+    global _SAVED
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        state = orjson.loads(data)
+    except FileNotFoundError:
+        return None
+    except orjson.JSONDecodeError:
+        print("Ignoring unreadable state file {}".format(path))
+        return None
+    if state.get("version") != VERSION:
+        return None
+
+    for saved in state["rules"]:
+        globals.add_rule(Rule(saved["value"], tag=saved["tag"], name=saved["name"], id=saved["id"]))
+    for saved in state["packed"]:
+        rule = Rule(saved["value"], tag=saved["tag"], name=saved["name"], id=saved["id"])
+        members = [globals.get_rule_by_id(id) for id in saved["members"] if id in globals.RULES]
+        globals.PACKED_RULES[rule.id] = rule
+        globals.PACKED[rule.id] = tuple(packing.LogicalRule(member.id, member.tag, member.rules) for member in members)
+    globals.PACKED_NEEDS.update(field_selection.merge(packing.needs(member.tree) 
+                                                      for members in globals.PACKED.values() for member in members))
+
+    for saved in state["handles"]:
+        predicate = saved.pop("predicate")
+        ids = saved.pop("rules")
+        if ids and not any(id in globals.RULES for id in ids):
+            print("The rules of handle {} are gone, it gets no tweets until it's given rules".format(saved["name"]))
+        selected = saved.pop("fields")
+        globals.add_handle(globals.Handle(rule_ids=ids, fields=tuple(selected) if selected else None,
+                                          predicate=Predicate(**predicate) if predicate else None, **saved))
+    for saved in state.get("shards", ()):
+        globals.SHARDS[saved["name"]] = Shard(**saved)
+    globals.SHARD_PLACEMENT = state.get("placement", globals.SHARD_PLACEMENT)
+    if state.get("ring"):
+        globals.RING = TweetRing(**state["ring"])
+    if state["packed"]:
+        globals.compile_dispatch()
+    _SAVED = data
+    return state["fingerprint"]
@@ -0,0 +1,76 @@
+'''
+A line of the stream read only as far as it's used. Routing needs the ids of the matching rules,
+which are found by a scan for the 'matching_rules' array and a parse of that array alone, and a raw
+handle writes the line as it came, so a tweet going only to raw handles, or to none, is never decoded
+
+@author: diego
+'''
+from orjson import orjson
+
+_KEY = b'"matching_rules"'
+EAGER_SIZE = 1024 # lines shorter than this decode as fast as they're scanned, so they're decoded at once
+
+def find_matching(line: bytes):
+    '''(start, end, rules) of the matching_rules array of a response, parsed without decoding the rest
+    of the line, None when it has none. The key is looked for from the end since it follows 'data',
+    and a quote in a text would be escaped'''
+    key = line.rfind(_KEY)
+    if key < 0:
+        return None
+    start = key + len(_KEY) + 1
+    if line[start - 1:start + 1] != b':[': # twitter's JSON is compact, anything else is looked at closer
+        start = line.find(b'[', key + len(_KEY))
+        if start < 0 or line[key + len(_KEY):start].strip() != b':':
+            return None
+    end = line.find(b']', start)
+    while end >= 0:
+        try:
+            return start, end + 1, orjson.loads(line[start:end + 1])
+        except orjson.JSONDecodeError: # a ']' in a tag
+            end = line.find(b']', end + 1)
+    return None
+
+class Tweet():
+    '''A response of the stream holding its raw line, decoded on the first access to more than its matching rules'''
+    __slots__ = ('line', '_matching', '_response')
+
+    def __init__(self, line: bytes):
+        self.line = line
+        if len(line) < EAGER_SIZE:
+            self._response = response = orjson.loads(line)
+            self._matching = response.get('matching_rules') if 'data' in response else None
+        else:
+            found = find_matching(line)
+            self._matching = found[2] if found is not None else None
+            self._response = None
+
+    @property
+    def response(self) -> dict:
+        '''the whole decoded response'''
+        if self._response is None:
+            self._response = orjson.loads(self.line)
+        return self._response
+
+    @property
+    def is_tweet(self) -> bool:
+        '''False for the errors twitter reports in-band'''
+        return self._matching is not None or 'data' in self.response
+
+    @property
+    def matching(self) -> list:
+        '''the matching_rules of the response, with their 'id' and 'tag' '''
+        if self._matching is None:
+            return self.response.get('matching_rules', [])
+        return self._matching
+
+    @property
+    def data(self) -> dict:
+        return self.response['data']
+
+    @property
+    def id(self) -> str:
+        return self.response['data']['id']
+
+    @property
+    def errors(self):
+        return self.response.get('errors')